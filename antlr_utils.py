@@ -116,6 +116,10 @@ add_custom_command(OUTPUT !!REPLACEME!!Lexer.cpp !!REPLACEME!!Parser.cpp
 add_executable(file_parser file_parser.cpp !!REPLACEME!!Lexer.cpp !!REPLACEME!!Parser.cpp)
 target_include_directories(file_parser PUBLIC ${ANTLR_RUNTIME}/runtime/src/)
 target_link_libraries(file_parser ${ANTLR_RUNTIME}/dist/libantlr4-runtime.a)
+
+add_executable(server_parser server_parser.cpp !!REPLACEME!!Lexer.cpp !!REPLACEME!!Parser.cpp)
+target_include_directories(server_parser PUBLIC ${ANTLR_RUNTIME}/runtime/src/)
+target_link_libraries(server_parser ${ANTLR_RUNTIME}/dist/libantlr4-runtime.a)
 """
 
     #add_executable(stdin_parser stdin_parser.cpp !!REPLACEME!!Lexer.cpp !!REPLACEME!!Parser.cpp)
@@ -125,10 +129,23 @@ target_link_libraries(file_parser ${ANTLR_RUNTIME}/dist/libantlr4-runtime.a)
     contents =contents.replace("!!REPLACEME!!", gram_name)
     return contents
 
-def parser_contents(gram_name: str, mode :str):
+# Printed on stderr by two-stage parsers each time SLL prediction fails and
+# they fall back to full LL.
+LL_FALLBACK_MARKER = "LL fallback"
+
+def parser_contents(gram_name: str, mode :str, two_stage: bool = False):
+    """
+    C++ source of a parser for the grammar `gram_name`. `mode` is "file",
+    "stdin" or "server" (a worker for oracle.py). If `two_stage` is set, each
+    input is first parsed with ANTLR's fast SLL prediction, bailing out at the
+    first error, and only re-parsed with full LL prediction if that fails. This
+    gives the same verdicts, since SLL never accepts an invalid input.
+    """
     parser_common= """
     #include <strstream>
 #include <string>
+#include <fstream>
+#include <iostream>
 #include "antlr4-runtime.h"
 #include "!!!REPLACEME!!!Lexer.h"
 #include "!!!REPLACEME!!!Parser.h"
@@ -147,8 +164,11 @@ class MyErrorListener: public antlr4::BaseErrorListener {
   }
 };
 
-int main(int argc, char *argv[]) {
-  !!!INPUT_MODE!!!
+int run(!!!REPLACEME!!!Parser &parser, MyErrorListener &errorListener) {
+  !!!RUN!!!
+}
+
+int check(antlr4::ANTLRInputStream &input) {
   !!!REPLACEME!!!Lexer lexer(&input);
   MyErrorListener errorListener;
   lexer.removeErrorListeners();
@@ -158,6 +178,14 @@ int main(int argc, char *argv[]) {
   !!!REPLACEME!!!Parser parser(&tokens);
   parser.removeErrorListeners();
   parser.addErrorListener(&errorListener);
+  return run(parser, errorListener);
+}
+
+int main(int argc, char *argv[]) {
+  !!!INPUT_MODE!!!
+}
+    """
+    one_stage_run = """
   try {
     antlr4::tree::ParseTree* tree = parser.start();
     return 0;
@@ -165,19 +193,93 @@ int main(int argc, char *argv[]) {
     std::cerr << e.what() << std::endl;
     return 10;
   }
-}
     """
+    two_stage_run = """
+  // Stage 1: SLL prediction, giving up at the first syntax error. Lexer errors
+  // still go through errorListener, since they don't depend on prediction.
+  parser.removeErrorListeners();
+  parser.setErrorHandler(std::make_shared<antlr4::BailErrorStrategy>());
+  parser.getInterpreter<antlr4::atn::ParserATNSimulator>()->setPredictionMode(antlr4::atn::PredictionMode::SLL);
+  try {
+    antlr4::tree::ParseTree* tree = parser.start();
+    return 0;
+  } catch (antlr4::ParseCancellationException &e) {
+  } catch (std::invalid_argument &e) {
+    std::cerr << e.what() << std::endl;
+    return 10;
+  }
+
+  // Stage 2: SLL may fail on valid inputs, so retry with full LL prediction
+  std::cerr << "!!!LL_FALLBACK!!!" << std::endl;
+  parser.reset();
+  parser.addErrorListener(&errorListener);
+  parser.setErrorHandler(std::make_shared<antlr4::DefaultErrorStrategy>());
+  parser.getInterpreter<antlr4::atn::ParserATNSimulator>()->setPredictionMode(antlr4::atn::PredictionMode::LL);
+  try {
+    antlr4::tree::ParseTree* tree = parser.start();
+    return 0;
+  } catch (std::invalid_argument &e) {
+    std::cerr << e.what() << std::endl;
+    return 10;
+  }
+    """.replace("!!!LL_FALLBACK!!!", LL_FALLBACK_MARKER)
+    parser_common = parser_common.replace("!!!RUN!!!", two_stage_run if two_stage else one_stage_run)
+
     file_input = """
-      std::ifstream input_file(argv[1]);
-  antlr4::ANTLRInputStream input(input_file);
+  if (argc == 2) {
+    std::ifstream input_file(argv[1]);
+    antlr4::ANTLRInputStream input(input_file);
+    return check(input);
+  }
+  // Batch mode (see oracle.py): one exit status per file on stdout
+  for (int i = 1; i < argc; i++) {
+    std::ifstream input_file(argv[i]);
+    antlr4::ANTLRInputStream input(input_file);
+    std::cout << check(input) << std::endl;
+  }
+  return 0;
     """
     stdin_input = """
     antlr4::ANTLRInputStream input(argv[1]);
+    return check(input);
+    """
+    # Worker protocol (see oracle.py): reads "<n>\n<n bytes>" requests on stdin and
+    # answers each with "<exit status>\n", reusing one lexer and parser throughout
+    server_input = """
+  antlr4::ANTLRInputStream empty("");
+  !!!REPLACEME!!!Lexer lexer(&empty);
+  MyErrorListener errorListener;
+  lexer.removeErrorListeners();
+  lexer.addErrorListener(&errorListener);
+  antlr4::CommonTokenStream tokens(&lexer);
+
+  !!!REPLACEME!!!Parser parser(&tokens);
+  parser.removeErrorListeners();
+  parser.addErrorListener(&errorListener);
+
+  std::ios::sync_with_stdio(false);
+  std::string header;
+  while (std::getline(std::cin, header)) {
+    size_t length = std::stoul(header);
+    std::string data(length, '\\0');
+    std::cin.read(&data[0], length);
+    if ((size_t) std::cin.gcount() != length) {
+      return 1;
+    }
+    antlr4::ANTLRInputStream input(data);
+    lexer.setInputStream(&input);
+    tokens.setTokenSource(&lexer);
+    parser.setTokenStream(&tokens);
+    std::cout << run(parser, errorListener) << std::endl;
+  }
+  return 0;
     """
 
     if mode == "stdin":
         return parser_common.replace("!!!REPLACEME!!!", gram_name).replace("!!!INPUT_MODE!!!", stdin_input)
     elif mode == "file":
         return parser_common.replace("!!!REPLACEME!!!", gram_name).replace("!!!INPUT_MODE!!!", file_input)
+    elif mode == "server":
+        return parser_common.replace("!!!INPUT_MODE!!!", server_input).replace("!!!REPLACEME!!!", gram_name)
     else: raise NotImplementedError(f"Don't know what to do with mode {mode}")
 
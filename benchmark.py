@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import time
+
+from bubble import Bubble
+from group import group, collect_bubbles, score_and_sort_bubbles, score_and_sort_all_bubbles, BubbleTable
+from next_tid import allocate_tid
+from parse_tree import ParseNode, ParseTreeList, START, build_grammar
+from relabel import TreeRelabeler, relabel_copying
+from start import apply, build_naive_parse_trees_2
+
+"""
+Micro-benchmarks of the internals of the search, on the seed inputs of a
+benchmark. See __main__ dispatch at the bottom for usage.
+"""
+
+
+def read_seed_trees(examples_dir: str, copies: int):
+    """
+    Naive parse trees (one nonterminal per character) of the files in
+    `examples_dir`, each repeated `copies` times.
+    """
+    leaves = []
+    for filename in sorted(os.listdir(examples_dir)):
+        raw = open(os.path.join(examples_dir, filename)).read()
+        if raw:
+            leaves.append([ParseNode(c, True, []) for c in raw])
+    trees = build_naive_parse_trees_2(leaves * copies)
+    for tree in trees:
+        tree.update_cache_info()
+    return trees
+
+
+def random_merges(trees, num_merges: int, seed=0):
+    """
+    A sequence of `num_merges` merges of two random nonterminals of `trees`, as
+    `get_class` maps like coalesce makes them.
+    """
+    rand = random.Random(seed)
+    nonterminals = sorted({nt for tree in trees for nt in tree.all_nts()} - {START})
+    merges = []
+    while len(merges) < num_merges and len(nonterminals) > 1:
+        first, second = rand.sample(nonterminals, 2)
+        class_nt = allocate_tid()
+        nonterminals = [nt for nt in nonterminals if nt not in (first, second)] + [class_nt]
+        merges.append({first: class_nt, second: class_nt})
+    return merges
+
+
+def bench_relabel(examples_dir: str, copies: int, num_merges: int):
+    """
+    Times the tree relabeling after each merge of a coalesce: copying and relabeling
+    every tree and recomputing the derivables, against relabeling the touched
+    trees in place.
+    """
+    trees = read_seed_trees(examples_dir, copies)
+    grammar = build_grammar(trees)
+    merges = random_merges(trees, num_merges)
+    print(f"{len(trees)} trees, {sum(len(tree.derived_string()) for tree in trees)} characters, {len(merges)} merges")
+
+    s = time.time()
+    tree_list = ParseTreeList(trees, grammar)
+    for get_class in merges:
+        tree_list = ParseTreeList(relabel_copying(tree_list.inner_list, get_class), grammar)
+    copying_time = time.time() - s
+    copied = tree_list
+
+    s = time.time()
+    tree_list = ParseTreeList(trees, grammar)
+    relabeler = TreeRelabeler()
+    for get_class in merges:
+        tree_list = tree_list.merged(relabeler.relabel(tree_list.inner_list, get_class), grammar, get_class)
+    incremental_time = time.time() - s
+
+    assert copied.inner_list == tree_list.inner_list
+    assert dict(copied.derivables_from_nt) == dict(tree_list.derivables_from_nt)
+    per_merge = lambda total: total / max(len(merges), 1) * 1000
+    print(f"Copying relabel:     {per_merge(copying_time):.3f} ms per merge")
+    print(f"Incremental relabel: {per_merge(incremental_time):.3f} ms per merge")
+    print(f"Speedup: {copying_time / max(incremental_time, 1e-9):.1f}x")
+
+
+def bench_group(examples_dir: str, copies: int, steps: int, group_size: int):
+    """
+    Times the regrouping after each bubbling in build_trees, with and without a
+    BubbleTable kept across the regroupings. Each step bubbles up the best-ranked
+    grouping and merges its nonterminal with a random one, like a successful
+    bubbling followed by a coalesce.
+    """
+    trees = read_seed_trees(examples_dir, copies)
+    rand = random.Random(0)
+    table = BubbleTable()
+    full_time, table_time = 0, 0
+    describe = lambda groupings: [(grouping.bubble_str if isinstance(grouping, Bubble)
+                                   else (grouping[0].bubble_str, grouping[1].bubble_str), score)
+                                  for grouping, score in groupings]
+    for _ in range(steps):
+        with contextlib.redirect_stdout(io.StringIO()):
+            s = time.time()
+            groupings = group(trees, group_size, False)
+            full_time += time.time() - s
+            s = time.time()
+            assert describe(group(trees, group_size, False, table=table)) == describe(groupings)
+            table_time += time.time() - s
+        if not groupings:
+            break
+        grouping = groupings[0][0]
+        if isinstance(grouping, Bubble):
+            trees = apply(grouping, trees)
+            new_nts = [grouping.new_nt]
+        else:
+            trees = apply(grouping[1], apply(grouping[0], trees))
+            new_nts = [grouping[0].new_nt, grouping[1].new_nt]
+        nonterminals = sorted({nt for tree in trees for nt in tree.all_nts()} - {START} - set(new_nts))
+        get_class = {nt: allocate_tid() for nt in new_nts}
+        if nonterminals:
+            get_class[rand.choice(nonterminals)] = get_class[new_nts[0]]
+        trees = relabel_copying(trees, get_class)
+    per_step = lambda total: total / max(steps, 1) * 1000
+    print(f"{len(trees)} trees, {steps} regroupings of groups up to {group_size}")
+    print(f"Full regrouping:        {per_step(full_time):.3f} ms per step")
+    print(f"Regrouping with table:  {per_step(table_time):.3f} ms per step")
+    print(f"Speedup: {full_time / max(table_time, 1e-9):.1f}x")
+
+
+def bench_rank(examples_dir: str, copies: int, group_size: int, limit: int):
+    """
+    Times ranking the pairs of bubbles of the seed trees: scoring and sorting all of
+    them, against keeping only the best `limit` with bounds on the scores. Checks both
+    give the same groupings.
+    """
+    trees = read_seed_trees(examples_dir, copies)
+    bubbles = collect_bubbles(trees, group_size, False)
+    print(f"{len(bubbles)} bubbles of groups up to {group_size}")
+
+    s = time.time()
+    ranked = score_and_sort_all_bubbles(bubbles)[:limit]
+    all_time = time.time() - s
+
+    s = time.time()
+    assert score_and_sort_bubbles(bubbles, limit) == ranked
+    top_time = time.time() - s
+    print(f"Scoring all pairs:  {all_time * 1000:.3f} ms")
+    print(f"Bounded top {limit}:    {top_time * 1000:.3f} ms")
+    print(f"Speedup: {all_time / max(top_time, 1e-9):.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(help='which part of the search to benchmark', dest='mode')
+    relabel_parser = subparsers.add_parser('relabel', help='relabeling the trees after each merge in coalesce')
+    relabel_parser.add_argument('examples_dir', help='folder containing the training examples', type=str)
+    relabel_parser.add_argument('--copies', help='use this many copies of each example (default 1)', type=int, default=1)
+    relabel_parser.add_argument('--merges', help='number of merges to time (default 100)', type=int, default=100)
+    group_parser = subparsers.add_parser('group', help='regrouping the trees into bubbles after each bubbling')
+    group_parser.add_argument('examples_dir', help='folder containing the training examples', type=str)
+    group_parser.add_argument('--copies', help='use this many copies of each example (default 1)', type=int, default=1)
+    group_parser.add_argument('--steps', help='number of bubblings to regroup after (default 20)', type=int, default=20)
+    group_parser.add_argument('--group-size', help='max number of elements in a bubble (default 4)', type=int, default=4, dest='group_size')
+    rank_parser = subparsers.add_parser('rank', help='ranking the pairs of bubbles of the seed trees')
+    rank_parser.add_argument('examples_dir', help='folder containing the training examples', type=str)
+    rank_parser.add_argument('--copies', help='use this many copies of each example (default 1)', type=int, default=1)
+    rank_parser.add_argument('--group-size', help='max number of elements in a bubble (default 6)', type=int, default=6, dest='group_size')
+    rank_parser.add_argument('--limit', help='number of groupings to keep (default 100)', type=int, default=100)
+    args = parser.parse_args()
+    if args.mode == 'relabel':
+        bench_relabel(args.examples_dir, args.copies, args.merges)
+    elif args.mode == 'group':
+        bench_group(args.examples_dir, args.copies, args.steps, args.group_size)
+    elif args.mode == 'rank':
+        bench_rank(args.examples_dir, args.copies, args.group_size, args.limit)
+    else:
+        parser.print_help()
+        exit(1)
@@ -1,12 +1,19 @@
+import bisect
 import functools
 import re
-from typing import Tuple, List
+from typing import Dict, Tuple, List
 
 from collections import defaultdict
 
 from parse_tree import ParseNode
 from replacement_utils import get_overlaps
 
+try:
+    import numpy as np
+except ImportError:
+    # Optional: without it, `ContextMatrix` scores one pair of bubbles at a time
+    np = None
+
 
 
 @functools.lru_cache(maxsize=None)
@@ -80,6 +87,262 @@ class Context:
             return lhs_score + rhs_score
 
 
+# What a match at each position adds in `side_similarity`
+POSITION_WEIGHTS = [1 / (2 ** (i + 2)) for i in range(4)]
+
+
+def side_elements(sides, reversed = False) -> List[set]:
+    """
+    For each of the k = 4 positions compared by `side_similarity`, the elements that
+    `sides` have there, with the length of the side standing for the sides too short
+    to have one. DUMMY never matches, so it is left out.
+    >>> side_elements([('a', 'b'), ('DUMMY', 'b')], reversed = True)
+    [{'b'}, {'a'}, {2}, {2}]
+    """
+    elements = [set() for _ in range(4)]
+    for side in sides:
+        for i in range(4):
+            if i < len(side):
+                element = side[-(i + 1) if reversed else i]
+                if element != 'DUMMY':
+                    elements[i].add(element)
+            else:
+                elements[i].add(len(side))
+    return elements
+
+
+def side_bound(sides, other_sides, elements, other_elements) -> float:
+    """
+    Upper bound of `side_similarity` over all pairs of a side in `sides` and one in
+    `other_sides`: a position can only add to it if some side of each has the same
+    element there.
+    """
+    if not sides.isdisjoint(other_sides):
+        return 0.5
+    bound = 0
+    for weight, position, other_position in zip(POSITION_WEIGHTS, elements, other_elements):
+        if not position.isdisjoint(other_position):
+            bound += weight
+    return bound
+
+
+class ContextBounds:
+    """
+    Summary of the contexts of a bubble that bounds `Bubble.context_similarity` from
+    above without comparing every pair of contexts.
+    >>> ctx = lambda lhs, rhs: Context(tuple(lhs), tuple(rhs))
+    >>> first = ContextBounds([ctx(['START', 'a'], ['b', 'END']), ctx(['START', 'c'], ['d', 'END'])])
+    >>> second = ContextBounds([ctx(['START', 'a'], ['d', 'e', 'END'])])
+    >>> first.similarity_bound(second)
+    0.75
+    >>> max(c.similarity(o) for c in first.contexts for o in second.contexts)
+    0.5
+    """
+
+    def __init__(self, contexts):
+        self.contexts = set(contexts)
+        self.lhs = {context.lhs for context in self.contexts}
+        self.rhs = {context.rhs for context in self.contexts}
+        self.lhs_elements = side_elements(self.lhs, reversed = True)
+        self.rhs_elements = side_elements(self.rhs)
+
+    def similarity_bound(self, other: 'ContextBounds') -> float:
+        if not self.contexts.isdisjoint(other.contexts):
+            # Only equal contexts have a similarity of 1, the highest there is
+            return 1
+        bound = side_bound(self.lhs, other.lhs, self.lhs_elements, other.lhs_elements) + \
+                side_bound(self.rhs, other.rhs, self.rhs_elements, other.rhs_elements)
+        # Unequal contexts have at most one equal side, and the other scores at most 15/32
+        return min(bound, 0.5 + 15 / 32)
+
+
+# Bits of what two bubbles can share in a `ContextIndex`: a context, a left or right
+# side, or an element at one of the positions of a side
+SHARED_CONTEXT = 1
+SHARED_SIDE = {'lhs': 2, 'rhs': 4}
+SHARED_ELEMENT = {'lhs': [8 << i for i in range(4)], 'rhs': [128 << i for i in range(4)]}
+
+
+@functools.lru_cache(maxsize=None)
+def shared_bound(shared: int) -> float:
+    """
+    `ContextBounds.similarity_bound` of two bubbles, given the bits of what they share.
+    >>> shared_bound(0), shared_bound(SHARED_SIDE['lhs'] | SHARED_ELEMENT['rhs'][1]), shared_bound(SHARED_CONTEXT)
+    (0, 0.625, 1)
+    """
+    if shared & SHARED_CONTEXT:
+        return 1
+    bound = 0
+    for side in ('lhs', 'rhs'):
+        if shared & SHARED_SIDE[side]:
+            bound += 0.5
+            continue
+        for weight, bit in zip(POSITION_WEIGHTS, SHARED_ELEMENT[side]):
+            if shared & bit:
+                bound += weight
+    return min(bound, 0.5 + 15 / 32)
+
+
+class ContextIndex:
+    """
+    Inverted index from the contexts, sides and side elements of a list of bubbles
+    (summed up by their `ContextBounds`) to the bubbles that have them. A pair of bubbles
+    that shares none of them has a `context_similarity` of exactly 0, and for the others,
+    what they share gives their `ContextBounds.similarity_bound`, so only those pairs
+    are visited.
+    >>> ctx = lambda lhs, rhs: Context(tuple(lhs), tuple(rhs))
+    >>> bounds = [ContextBounds([ctx(['START', 'a'], ['b', 'END']), ctx(['START', 'c'], ['d', 'END'])]),
+    ...           ContextBounds([ctx(['START', 'a'], ['d', 'e', 'END'])]),
+    ...           ContextBounds([ctx(['x', 'y', 'z', 'w'], ['u', 'v', 'q', 'r'])])]
+    >>> index = ContextIndex(bounds)
+    >>> {j: shared_bound(shared) for j, shared in index.sharing(0).items()}, dict(index.sharing(1))
+    ({1: 0.75}, {})
+    >>> bounds[0].similarity_bound(bounds[1]), bounds[0].similarity_bound(bounds[2])
+    (0.75, 0)
+    """
+
+    def __init__(self, bounds: List[ContextBounds]):
+        # (bit, what is shared) of each bubble
+        self.keys = [self._keys(bubble_bounds) for bubble_bounds in bounds]
+        # (bit, what is shared) -> indices of the bubbles that have it, in order
+        self.postings = defaultdict(list)
+        for idx, keys in enumerate(self.keys):
+            for key in keys:
+                self.postings[key].append(idx)
+
+    @staticmethod
+    def _keys(bounds: ContextBounds) -> set:
+        keys = {(SHARED_CONTEXT, context) for context in bounds.contexts}
+        for side, sides, elements in (('lhs', bounds.lhs, bounds.lhs_elements),
+                                      ('rhs', bounds.rhs, bounds.rhs_elements)):
+            keys.update((SHARED_SIDE[side], side_tuple) for side_tuple in sides)
+            for bit, position in zip(SHARED_ELEMENT[side], elements):
+                keys.update((bit, element) for element in position)
+        return keys
+
+    def sharing(self, idx: int) -> Dict[int, int]:
+        """
+        Maps each bubble after the `idx`th that shares something with it to the bits of
+        what they share, for `shared_bound`.
+        """
+        shared = defaultdict(int)
+        for key in self.keys[idx]:
+            bit = key[0]
+            postings = self.postings[key]
+            for other_idx in postings[bisect.bisect_right(postings, idx):]:
+                shared[other_idx] |= bit
+        return shared
+
+
+# Ids of the elements of a side in a `ContextMatrix`; payloads get the ids after these
+SENTINEL_IDS = {'DUMMY': 0, 'START': 1, 'END': 2}
+# Most pairs of contexts a `ContextMatrix` compares at once
+MAX_CONTEXT_PAIRS = 1 << 20
+
+
+def side_similarities(sides, other_sides):
+    """
+    `side_similarity` of each row of `sides` with the same row of `other_sides`, as
+    `ContextMatrix` encodes them.
+    """
+    equal = sides == other_sides
+    matches = equal & (sides != SENTINEL_IDS['DUMMY'])
+    return np.where(equal.all(axis=1), 0.5, matches @ np.array(POSITION_WEIGHTS))
+
+
+class ContextMatrix:
+    """
+    The contexts of a list of bubbles as integer matrices, to compute
+    `Bubble.context_similarity` for a batch of pairs of them with NumPy. Each context is
+    a row of `lhs` and of `rhs`, and each column a position of the side as
+    `side_similarity` counts them, nearest to the bubble first. Elements are ids (see
+    `SENTINEL_IDS`), and a position past the end of a side is padding, -1 - the length
+    of the side, so it only matches the padding of a side of the same length.
+
+    Without NumPy, the similarities are computed with `Bubble.context_similarity`.
+    >>> def bubble(*contexts):
+    ...     new_bubble = Bubble('t0', [], 0)
+    ...     for lhs, rhs in contexts:
+    ...         new_bubble.contexts[Context(tuple(lhs), tuple(rhs))] += 1
+    ...     return new_bubble
+    >>> bubbles = [bubble((['START', 'a'], ['b', 'END']), (['DUMMY', 'c'], ['d', 'END'])),
+    ...            bubble((['START', 'a'], ['d', 'e', 'END'])),
+    ...            bubble((['x', 'c'], ['b']), (['DUMMY', 'c'], ['d', 'END'])),
+    ...            bubble((['y'], ['z']))]
+    >>> pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (2, 3)]
+    >>> ContextMatrix(bubbles).similarities(pairs)
+    [0.5, 1, 0, 0.34375, 0.21875]
+    >>> _ == [bubbles[i].context_similarity(bubbles[j]) for i, j in pairs]
+    True
+    """
+
+    def __init__(self, bubbles: List['Bubble']):
+        self.bubbles = bubbles
+        # Whether similarities are computed in batches, rather than one pair at a time
+        self.batched = np is not None
+        if not self.batched:
+            return
+        ids = dict(SENTINEL_IDS)
+
+        def encode(side, reversed = False) -> List[int]:
+            row = [-1 - len(side)] * 4
+            for i, element in enumerate(side[::-1] if reversed else side):
+                row[i] = ids.setdefault(element, len(ids))
+            return row
+
+        lhs, rhs = [], []
+        for bubble in bubbles:
+            for context in bubble.contexts:
+                lhs.append(encode(context.lhs, reversed = True))
+                rhs.append(encode(context.rhs))
+        self.lhs = np.array(lhs, dtype=np.int64).reshape(-1, 4)
+        self.rhs = np.array(rhs, dtype=np.int64).reshape(-1, 4)
+        # Number of contexts of each bubble, and the row of its first one
+        self.counts = np.array([len(bubble.contexts) for bubble in bubbles], dtype=np.int64)
+        self.offsets = np.cumsum(self.counts) - self.counts
+
+    def similarities(self, pairs: List[Tuple[int, int]]) -> List[float]:
+        """
+        `Bubble.context_similarity` of each pair of indices of bubbles in `pairs`.
+        """
+        if not self.batched:
+            return [self.bubbles[i].context_similarity(self.bubbles[j]) for i, j in pairs]
+        if not pairs:
+            return []
+        first, second = np.array(pairs, dtype=np.int64).reshape(-1, 2).T
+        sizes = self.counts[first] * self.counts[second]
+        similarities = np.zeros(len(pairs))
+        # Chunks of pairs that compare at most MAX_CONTEXT_PAIRS pairs of contexts, or one pair
+        ends = np.cumsum(sizes)
+        start = 0
+        while start < len(pairs):
+            end = max(int(np.searchsorted(ends, ends[start] - sizes[start] + MAX_CONTEXT_PAIRS, side='right')), start + 1)
+            chunk = slice(start, end)
+            similarities[chunk] = self._max_similarities(first[chunk], second[chunk], sizes[chunk])
+            start = end
+        # As `Bubble.context_similarity` gives them: 1 for a shared context, 0 if nothing matches
+        return [int(similarity) if similarity in (0, 1) else similarity for similarity in similarities.tolist()]
+
+    def _max_similarities(self, first, second, sizes):
+        """
+        The highest `Context.similarity` of a context of each bubble in `first` with one
+        of the same bubble in `second`, or 0 if either has none.
+        """
+        starts = np.cumsum(sizes) - sizes
+        pair_of = np.repeat(np.arange(len(sizes)), sizes)
+        within = np.arange(pair_of.size) - starts[pair_of]
+        columns = self.counts[second][pair_of]
+        rows = self.offsets[first][pair_of] + within // columns
+        other_rows = self.offsets[second][pair_of] + within % columns
+        similarity = side_similarities(self.lhs[rows], self.lhs[other_rows]) + \
+                     side_similarities(self.rhs[rows], self.rhs[other_rows])
+        best = np.zeros(len(sizes))
+        nonempty = sizes > 0
+        if nonempty.any():
+            best[nonempty] = np.maximum.reduceat(similarity, starts[nonempty])
+        return best
+
+
 class Bubble:
     """
     Represents a `bubble`, that is, a sequence of terminals/nonterminals that are to be
@@ -131,6 +394,9 @@ class Bubble:
     #     return self.bubbled_elems
 
     def context_similarity(self, other):
+        # Only equal contexts have a similarity of 1, the highest there is
+        if not self.contexts.keys().isdisjoint(other.contexts.keys()):
+            return 1
         num_pairs = 0
         total_similarity = 0
         max_similarity = 0
@@ -8,7 +8,7 @@ from parse_tree import ParseTree, ParseNode
 from grammar import Grammar, Rule
 from start import get_times, START
 from lark import Lark
-from oracle import CachingOracle, ExternalOracle
+from oracle import CachingOracle, ExternalOracle, make_oracle, INPUT_MODES, TIMEOUT_LATENCY_FACTOR
 import string
 
 """
@@ -17,6 +17,12 @@ High-level command line to launch Arvada evaluation.
 See __main__ dispatch at the bottom for usage. 
 """
 PRECISION_SIZE=1000
+# Number of precision examples handed to the oracle at once
+PRECISION_BATCH_SIZE=64
+# Deadline in seconds for an oracle query. None derives it from the latencies
+# of the first precision batch (times ORACLE_TIMEOUT_FACTOR); 0 means no deadline.
+ORACLE_TIMEOUT = None
+ORACLE_TIMEOUT_FACTOR = TIMEOUT_LATENCY_FACTOR
 
 def main_internal(external_folder, log_file, random_guides=False):
     """
@@ -35,11 +41,18 @@ def main_internal(external_folder, log_file, random_guides=False):
     bench_name = os.path.basename(external_folder)
     test_folder = os.path.join(external_folder, "test_set")
     parser_command = os.path.join(external_folder, f"parse_{bench_name}")
+    # ANTLR benchmarks also come with a long-lived worker
+    worker_command = os.path.join(external_folder, f"serve_{bench_name}")
+    if not os.path.exists(worker_command):
+        worker_command = None
     
-    main(parser_command, log_file, test_folder)
+    main(parser_command, log_file, test_folder, worker_command)
 
-def main(oracle_cmd, log_file_name, test_examples_folder ):
-    oracle = ExternalOracle(oracle_cmd)
+def main(oracle_cmd, log_file_name, test_examples_folder, worker_cmd=None, jobs=1, oracle_processes=0, cache_file=None, cache_mb=None,
+         record_file=None, replay_file=None, input_mode='file', batch_size=0, zygote=False):
+    cache_budget = cache_mb * 2**20 if cache_mb is not None else None
+    oracle = make_oracle(oracle_cmd, worker_cmd, jobs, oracle_processes, cache_file, cache_budget,
+                         ORACLE_TIMEOUT or None, record_file, replay_file, input_mode, batch_size, zygote)
 
 
     real_recall_set = []
@@ -76,14 +89,19 @@ def main(oracle_cmd, log_file_name, test_examples_folder ):
         print(f"Precision set (size {len(precision_set)}):", file=f)
         print(f"Precision set (size {len(precision_set)}):")
         print("Eval of precision:")
-        for example in tqdm(precision_set):
-            try:
-                oracle.parse(example, timeout=10)
-                print("Passed\n", example, file=f)
-                num_precision_parsed += 1
-            except Exception as e:
-                print("Failed", example, " <----- FAILURE", file=f)
-                continue
+        precision_list = list(precision_set)
+        with tqdm(total=len(precision_list)) as progress:
+            for batch_start in range(0, len(precision_list), PRECISION_BATCH_SIZE):
+                batch = precision_list[batch_start:batch_start + PRECISION_BATCH_SIZE]
+                for example, verdict in zip(batch, oracle.parse_many(batch, fail_fast=False)):
+                    if verdict:
+                        print("Passed\n", example, file=f)
+                        num_precision_parsed += 1
+                    else:
+                        print("Failed", example, " <----- FAILURE", file=f)
+                progress.update(len(batch))
+                if ORACLE_TIMEOUT is None and batch_start == 0:
+                    oracle.adapt_timeout(ORACLE_TIMEOUT_FACTOR)
 
         example_gen_time = time.time()
         num_recall_parsed = 0
@@ -115,6 +133,16 @@ def main(oracle_cmd, log_file_name, test_examples_folder ):
 
         print(f'Example gen time: {example_gen_time - start_time}', file=f)
         print(f'Scoring time: {time.time() - example_gen_time}', file=f)
+        print(f'Parse calls: {oracle.parse_calls}, {oracle.real_calls}', file=f)
+        print(f'Oracle cache: {oracle.cache_set.stats()}', file=f)
+        if oracle.disk_cache is not None:
+            print(f'Disk cache: {oracle.disk_cache.stats()}')
+            print(f'Disk cache: {oracle.disk_cache.stats()}', file=f)
+        print(f'Oracle timeouts (assumed valid): {len(oracle.timeouts)} with deadline {oracle.timeout}s')
+        print(f'Oracle timeouts (assumed valid): {len(oracle.timeouts)} with deadline {oracle.timeout}s', file=f)
+        for timed_out in oracle.timeouts:
+            print(f'    {repr(timed_out)}', file=f)
+    oracle.close()
 
 
 if __name__ == '__main__':
@@ -125,10 +153,22 @@ if __name__ == '__main__':
 
     internal_parser.add_argument('bench_folder', help='folder containing the benchmark', type=str)
     internal_parser.add_argument('log_file', help='log file output from search.py', type=str)
-    external_parser.add_argument('oracle_cmd', help='the oracle command; should be invocable on a filename via `oracle_cmd filename`, and return a non-zero exit code on invalid inputs', type=str)
+    external_parser.add_argument('oracle_cmd', help='the oracle command; should be invocable on a filename via `oracle_cmd filename`, and return a non-zero exit code on invalid inputs. A `module:function` spec calls a Python function in-process instead', type=str)
     external_parser.add_argument('examples_dir', help='folder containing the test (recall) examples', type=str)
     external_parser.add_argument('log_file', help='log file output from search.py', type=str)
     external_parser.add_argument('-n', '--precision_set_size', help='size of precision set to sample from learned grammar (default 1000)', type=int, default=1000)
+    external_parser.add_argument('--worker-cmd', help='a long-lived oracle worker speaking the length-prefixed protocol described in oracle.py; oracle_cmd is used as a fallback', type=str, default=None, dest='worker_cmd')
+    external_parser.add_argument('--timeout', help='deadline in seconds for an oracle query, after which the input is assumed valid; 0 for none (default: derived from the first queries)', type=float, default=None)
+    external_parser.add_argument('--timeout-factor', help=f'with no --timeout, the deadline is this times the 99th percentile time of the first oracle queries (default {TIMEOUT_LATENCY_FACTOR})', type=float, default=TIMEOUT_LATENCY_FACTOR, dest='timeout_factor')
+    external_parser.add_argument('-j', '--jobs', help='number of oracle queries to run concurrently (default 1)', type=int, default=1)
+    external_parser.add_argument('--oracle-processes', help='with a `module:function` oracle, call it in a pool of this many processes instead of in-process', type=int, default=0, dest='oracle_processes')
+    external_parser.add_argument('--cache-db', help='sqlite file to keep the oracle answers in across runs; created if it does not exist', type=str, default=None, dest='cache_file')
+    external_parser.add_argument('--cache-mb', help='memory budget in MB of the in-memory oracle cache (default unbounded); least useful answers are evicted beyond it', type=float, default=None, dest='cache_mb')
+    external_parser.add_argument('--record', help='record the oracle answers of this run to a trace file', type=str, default=None, dest='record_file')
+    external_parser.add_argument('--replay', help='answer oracle queries from a trace recorded with --record instead of running oracle_cmd, failing on queries missing from it', type=str, default=None, dest='replay_file')
+    external_parser.add_argument('--input-mode', help='how inputs are handed to oracle_cmd: a temporary file per query (default), piped on stdin as /dev/stdin, an in-memory memfd, or a reused tmpfs file', choices=INPUT_MODES, default='file', dest='input_mode')
+    external_parser.add_argument('--batch-size', help='check up to this many inputs per run of oracle_cmd, as `oracle_cmd f1 ... fN`; see "Batch mode" in oracle.py for the output it must produce', type=int, default=0, dest='batch_size')
+    external_parser.add_argument('--zygote', help='oracle_cmd is a Python script: run it from a pre-forked zygote server (zygote.py) that keeps its imports loaded, instead of starting Python for each query', action='store_true')
 
     args = parser.parse_args()
     if args.mode == 'internal':
@@ -136,7 +176,10 @@ if __name__ == '__main__':
     elif args.mode == 'external':
         if args.precision_set_size is not None:
             PRECISION_SIZE = args.precision_set_size
-        main(args.oracle_cmd, args.log_file, args.examples_dir)
+        ORACLE_TIMEOUT = args.timeout
+        ORACLE_TIMEOUT_FACTOR = args.timeout_factor
+        main(args.oracle_cmd, args.log_file, args.examples_dir, args.worker_cmd, args.jobs, args.oracle_processes, args.cache_file, args.cache_mb,
+             args.record_file, args.replay_file, args.input_mode, args.batch_size, args.zygote)
     else:
         parser.print_help()
         exit(1)
@@ -1,10 +1,12 @@
 from lib2to3.pgen2 import token
 from math import ceil
+import heapq
+import itertools
 import random
 from collections import defaultdict
 from typing import Union, List, Dict, Tuple
 
-from bubble import Bubble
+from bubble import Bubble, Context, ContextBounds, ContextIndex, ContextMatrix, shared_bound
 from next_tid import allocate_tid
 from parse_tree import ParseNode
 
@@ -40,14 +42,33 @@ def is_balanced(tokens: str):
         return False
 
 imbalance = 0
-def group(trees, max_group_size, increment: bool, last_applied_bubble = None) -> List[Bubble]:
+def group(trees, max_group_size, increment: bool, last_applied_bubble = None, table: 'BubbleTable' = None) -> List[Bubble]:
     """
     TREES is a set of ParseNodes.
 
     Returns the set of all possible bubble of nonterminals in TREES,
     where each bubble is a data structure holding information about a
     grouping of contiguous nonterminals in TREES.
+
+    If TABLE is given, the windows of the tree layers that are the same as
+    in the last call with TABLE are taken from it instead of being recomputed.
+    """
+    bubbles = collect_bubbles(trees, max_group_size, increment, table)
+    print("Number of bubbles: ", len(bubbles))
+
+    bubbles = score_and_sort_bubbles(bubbles)
+
+    # Return the set of repeated groupings as an iterable
+    return bubbles
+
+
+def collect_bubbles(trees, max_group_size, increment: bool, table: 'BubbleTable' = None) -> Dict[str, Bubble]:
+    """
+    The bubbles of `group`, by bubble string, before they are scored.
     """
+    if table is None:
+        table = BubbleTable()
+    table.start(max_group_size, increment)
 
     # Helper tracking if a subsequence is only seen as the "full" child of another nonterminal,
     # I.e. t2 t3 t4 in t1 -> t2 t3 t4, but not in t1 -> t2 t2 t3 t4
@@ -63,45 +84,21 @@ def group(trees, max_group_size, increment: bool, last_applied_bubble = None) ->
         #     print("skipping subtree:" tree)
         #     return
 
-        for i in range(len(children_lst)):
-            
-            inc = 1
-            if increment:
-                inc = max_group_size - 1
-            for j in range(i + 1, min(len(children_lst) + 1, i + max_group_size + 1), inc):
-                # if j - i == 2:
-                #     continue
-                tree_sublist = children_lst[i:j]
-                # discard a bubble if it's a single terminal
-                if len(tree_sublist) == 1 and tree_sublist[0].is_terminal:
-                    continue
-
-                # discard a bubble if it's not bracket balanced
-                stream = ''.join([child.derived_string() for child in tree_sublist])
-                if not is_balanced(stream):
-                    global imbalance
-                    imbalance += 1
-                    continue
+        source = (tree_idx, tuple(child_idxs))
+        for tree_substr, i, j, full, context in table.windows(children_lst, left_context, right_context):
+            if full:
+                # TODO: add direct parent to bubble
+                full_bubbles[tree_substr] += 1
 
-                tree_substr = ''.join([t.payload for t in tree_sublist])
-                if i == 0 and j == len(children_lst):
-                    # TODO: add direct parent to bubble
-                    full_bubbles[tree_substr] += 1
-
-                lhs_context = [ParseNode(left_context, True, [])] + children_lst[:i]
-                rhs_context = children_lst[j:] + [ParseNode(right_context, True, [])]
-
-                if not tree_substr in bubbles:
-                    bubble = Bubble(allocate_tid(), tree_sublist, depth)
-                    bubble.add_context(lhs_context, rhs_context)
-                    bubbles[tree_substr] = bubble
-                    bubble.add_source(tree_idx, child_idxs, (i, j-1))
-                else:
-                    bubble: Bubble = bubbles[tree_substr]
-                    bubble.add_occurrence()
-                    bubble.add_context(lhs_context, rhs_context)
-                    bubble.add_source(tree_idx, child_idxs, (i, j-1))
-                    bubble.set_depth(min(bubble.depth, depth))
+            if not tree_substr in bubbles:
+                bubble = Bubble(allocate_tid(), children_lst[i:j], depth)
+                bubbles[tree_substr] = bubble
+            else:
+                bubble: Bubble = bubbles[tree_substr]
+                bubble.add_occurrence()
+                bubble.set_depth(min(bubble.depth, depth))
+            bubble.contexts[context] += 1
+            bubble.sources[source].append((i, j - 1))
 
         # Recurse down in the other layers
         for i, child in enumerate(tree.children):
@@ -122,17 +119,280 @@ def group(trees, max_group_size, increment: bool, last_applied_bubble = None) ->
     for bubble_str in full_bubbles:
         if bubbles[bubble_str].occ_count == full_bubbles[bubble_str]:
             bubbles.pop(bubble_str)
-    print("Number of bubbles: ", len(bubbles))
+    return bubbles
 
-    bubbles = score_and_sort_bubbles(bubbles)
 
-    # Return the set of repeated groupings as an iterable
-    return bubbles
+class BubbleTable:
+    """
+    The windows of each tree layer that `group` computed in its last call, by the
+    layer's children and contexts, so the next call only computes the windows of
+    layers that the bubblings and merges since then changed. It still walks every
+    layer to collect the bubbles, and scores every pair of them again. Layers not
+    seen in a call are dropped at the next one.
+
+    A bubble's nonterminal is allocated anew in every call, in the same order as
+    without a table, so `group` returns the same groupings either way.
+    """
+
+    def __init__(self):
+        self.settings = None
+        # (payloads, terminal flags, derived strings, left context, right context)
+        # of a layer -> (windows, number of unbalanced windows)
+        self.layers = {}
+        self.old_layers = {}
+
+    def start(self, max_group_size: int, increment: bool):
+        """
+        Begins a call of `group` with the given settings.
+        """
+        if self.settings != (max_group_size, increment):
+            self.settings = (max_group_size, increment)
+            self.layers = {}
+        self.old_layers, self.layers = self.layers, {}
+
+    def windows(self, children_lst: List[ParseNode], left_context: str, right_context: str) \
+            -> List[Tuple[str, int, int, bool, Context]]:
+        """
+        The windows children_lst[i:j] of a layer that are bubbles, as (bubble string, i, j,
+        whether the window is all of `children_lst`, context of the window).
+        """
+        global imbalance
+        key = (tuple([child.payload for child in children_lst]), tuple([child.is_terminal for child in children_lst]),
+               tuple([child.derived_string() for child in children_lst]), left_context, right_context)
+        entry = self.layers.get(key)
+        if entry is None:
+            entry = self.old_layers.get(key)
+            if entry is None:
+                entry = self.compute_windows(children_lst, left_context, right_context)
+            self.layers[key] = entry
+        windows, unbalanced = entry
+        imbalance += unbalanced
+        return windows
+
+    def compute_windows(self, children_lst: List[ParseNode], left_context: str, right_context: str):
+        max_group_size, increment = self.settings
+        windows, unbalanced = [], 0
+        for i in range(len(children_lst)):
+
+            inc = 1
+            if increment:
+                inc = max_group_size - 1
+            for j in range(i + 1, min(len(children_lst) + 1, i + max_group_size + 1), inc):
+                # if j - i == 2:
+                #     continue
+                tree_sublist = children_lst[i:j]
+                # discard a bubble if it's a single terminal
+                if len(tree_sublist) == 1 and tree_sublist[0].is_terminal:
+                    continue
+
+                # discard a bubble if it's not bracket balanced
+                stream = ''.join([child.derived_string() for child in tree_sublist])
+                if not is_balanced(stream):
+                    unbalanced += 1
+                    continue
+
+                tree_substr = ''.join([t.payload for t in tree_sublist])
+                full = i == 0 and j == len(children_lst)
+                lhs_context = [left_context] + [t.payload for t in children_lst[:i]]
+                rhs_context = [t.payload for t in children_lst[j:]] + [right_context]
+                windows.append((tree_substr, i, j, full, Context(tuple(lhs_context), tuple(rhs_context))))
+        return windows, unbalanced
+
+
+def score_and_sort_bubbles(bubbles: Dict[str, Bubble], limit: int = 100) -> List[Union[Bubble, Tuple[Bubble, Bubble]]]:
+    """
+    Given a set of bubbles, returns a sorted list of (tuples of) bubbles, sorted by a score on how
+    likely the bubble(s) is to increase the size of the grammar.
+    Single bubble --> likely coalesces with existing nonterminal
+    Double bubble --> likely coalesces with each other
+
+    Only the best `limit` are returned. A pair of bubbles is scored only if an upper bound of its
+    score (from `ContextBounds`) could put it among them, best bounds first, so the result is the
+    same as the first `limit` of `score_and_sort_all_bubbles`, which scores every pair. Bounds are
+    only computed for the pairs that share some context element (found with a `ContextIndex`); the
+    others have a similarity of 0, and are only scored if fewer than `limit` pairs rank above them.
+    Similarities are computed with a `ContextMatrix`, for batches of the pairs next in bound order.
+    >>> leaves = lambda s: ParseNode('t0', False, [ParseNode(c, True, []) for c in s])
+    >>> trees = [leaves('1+(2*3)'), leaves('(4+5)*6'), leaves('7*8+9'), leaves('(1-2)/3')]
+    >>> bubbles = collect_bubbles(trees, 3, False)
+    >>> len(bubbles), len(score_and_sort_all_bubbles(bubbles))
+    (19, 100)
+    >>> score_and_sort_bubbles(bubbles) == score_and_sort_all_bubbles(bubbles)
+    True
+    >>> score_and_sort_bubbles(bubbles, 10) == score_and_sort_all_bubbles(bubbles)[:10]
+    True
+
+    The same on random forests over a small alphabet, which have many tied scores, with
+    limits below and above the number of groupings:
+    >>> rand = random.Random(0)
+    >>> mismatches, ties = [], 0
+    >>> for forest in range(40):
+    ...     trees = [leaves(''.join(rand.choice('ab(+)1') for _ in range(rand.randint(2, 8))))
+    ...              for _ in range(rand.randint(1, 5))]
+    ...     bubbles = collect_bubbles(trees, rand.randint(2, 4), False)
+    ...     reference = score_and_sort_all_bubbles(bubbles)
+    ...     scores = [grouping_score for _, grouping_score in reference]
+    ...     ties += sum(score == next_score for score, next_score in zip(scores, scores[1:]))
+    ...     mismatches.extend((forest, limit) for limit in (1, 7, 30, 100)
+    ...                       if score_and_sort_bubbles(bubbles, limit) != reference[:limit])
+    >>> mismatches, ties > 100
+    ([], True)
+    """
+
+    bubble_lst = list(sorted(list(bubbles.values()), key=lambda x: len(x.bubbled_elems), reverse=True))
+    occurrences = [sum([v for v in bubble.contexts.values()]) for bubble in bubble_lst]
+    index = ContextIndex([ContextBounds(bubble.contexts) for bubble in bubble_lst])
+    # Bubbles from here on are nonterms
+    first_single = next((i for i, bubble in enumerate(bubble_lst) if len(bubble.bubbled_elems) == 1), len(bubble_lst))
+    # i -> the bubbles after the ith that share some context element with it
+    sharing = {}
+    contexts = ContextMatrix(bubble_lst)
+    # (i, j) -> context similarity of the pairs computed so far
+    similarities = {}
+
+    def score(i, j, similarity):
+        """
+        The score of the pair of bubble_lst[i] and bubble_lst[j], given their similarity.
+        """
+        first_bubble, second_bubble = bubble_lst[i], bubble_lst[j]
+        if len(first_bubble.bubbled_elems) == 1:
+            commonness = occurrences[j] / 2
+        elif len(second_bubble.bubbled_elems) == 1:
+            commonness = occurrences[i]
+        else:
+            commonness = occurrences[i] / 2 + occurrences[j] / 2
+
+        if len(second_bubble.bubbled_elems) == 1:
+            bubble_depth = first_bubble.depth
+            bubble_len = - len(first_bubble.bubbled_elems)
+        else:
+            bubble_depth = (first_bubble.depth + second_bubble.depth) / 2
+            bubble_len = - (len(first_bubble.bubbled_elems) + len(second_bubble.bubbled_elems)) / 2
+        return similarity, bubble_depth, commonness, bubble_len
+
+    def grouping_of(i, j):
+        """
+        The grouping made of bubble_lst[i] and bubble_lst[j], and its score, or None if each
+        breaks the other.
+        """
+        first_bubble, second_bubble = bubble_lst[i], bubble_lst[j]
+        # Skip overlapping/conflicting pairs
+        first_prevents_second, second_prevents_first = first_bubble.application_breaks_other(second_bubble)
+        if first_prevents_second and second_prevents_first:
+            return None
+        # Pairs that share no context element have a similarity of 0
+        pair_score = score(i, j, context_similarity(i, j) if j in sharing[i] else 0)
+        # Bubbles paired w/ a nonterm are single bubbles
+        if len(second_bubble.bubbled_elems) == 1:
+            return first_bubble, pair_score
+        # If they're partially overlapping, we may need a particular application order.
+        if first_prevents_second:
+            return (second_bubble, first_bubble), pair_score
+        return (first_bubble, second_bubble), pair_score
 
-        
+    # The groupings ranked as in score_and_sort_all_bubbles, by score and then by the position
+    # (i, j) of the pair among the pairs in the order they are scored there: a single bubble
+    # ranks as its best pair with a nonterm. Upper bounds of the ranks of the pairs that share
+    # some context element: one per pair of two bubbles, and one per bubble for its pairs with
+    # a nonterm, which are in `single_bounds`
+    bounds_of_ranks = []
+    single_bounds = defaultdict(list)
+    # Pairs of existing terminals we don't care about
+    for i in range(first_single):
+        sharing[i] = index.sharing(i)
+        for j, shared in sharing[i].items():
+            bound = score(i, j, shared_bound(shared))
+            if j >= first_single:
+                single_bounds[i].append((bound, -i, -j))
+            else:
+                bounds_of_ranks.append((bound, -i, -j))
+        if single_bounds[i]:
+            single_bounds[i].sort(reverse=True)
+            bounds_of_ranks.append(single_bounds[i][0])
+    bounds_of_ranks.sort(reverse=True)
 
-def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tuple[Bubble, Bubble]]]:
+    def pairs_in_bound_order():
+        """
+        The pairs that share some context element, in the order they are scored below.
+        """
+        for _, i, j in bounds_of_ranks:
+            if -j >= first_single:
+                yield from ((-i, -single_bound[2]) for single_bound in single_bounds[-i])
+            else:
+                yield -i, -j
+
+    upcoming = pairs_in_bound_order()
+
+    def context_similarity(i, j):
+        """
+        The context similarity of bubble_lst[i] and bubble_lst[j]. If it is not computed yet,
+        computes it along with the next pairs in bound order, as many as were computed so far.
+        """
+        if (i, j) not in similarities:
+            batch = [(i, j)]
+            if contexts.batched:
+                batch.extend(pair for pair in itertools.islice(upcoming, max(len(similarities), limit))
+                             if pair not in similarities and pair != (i, j))
+            similarities.update(zip(batch, contexts.similarities(batch)))
+        return similarities[(i, j)]
+
+    def unshared_singles(i):
+        """
+        The ranks of the pairs of bubble_lst[i] with the nonterms it shares no context element with,
+        best first.
+        """
+        return ((score(i, j, 0), -i, -j) for j in range(first_single, len(bubble_lst)) if j not in sharing[i])
+
+    def unshared_ranks():
+        """
+        The ranks of the pairs that share no context element, which all rank below the others,
+        best first: one per pair of two bubbles, and one per bubble for its pairs with a nonterm
+        if it shares none with any.
+        """
+        if len(best) == limit and best[0][0][0][0] > 0:
+            # None of them can make it
+            return
+        ranks = []
+        for i in range(first_single):
+            ranks.extend((score(i, j, 0), -i, -j) for j in range(i + 1, first_single) if j not in sharing[i])
+            if not single_bounds[i]:
+                ranks.extend(itertools.islice(unshared_singles(i), 1))
+        yield from sorted(ranks, reverse=True)
+
+    # Min-heap of (rank, grouping, score) of the best `limit` groupings so far
+    best = []
+    for bound_of_rank in itertools.chain(bounds_of_ranks, unshared_ranks()):
+        if len(best) == limit and bound_of_rank < best[0][0]:
+            break
+        _, i, j = bound_of_rank
+        i, j = -i, -j
+        ranked = None
+        if j >= first_single:
+            for single_bound in itertools.chain(single_bounds[i], unshared_singles(i)):
+                if ranked is not None and single_bound < ranked[0]:
+                    break
+                grouping = grouping_of(i, -single_bound[2])
+                if grouping is not None:
+                    rank = (grouping[1], -i, single_bound[2])
+                    if ranked is None or rank > ranked[0]:
+                        ranked = (rank,) + grouping
+        else:
+            grouping = grouping_of(i, j)
+            if grouping is not None:
+                ranked = ((grouping[1], -i, -j),) + grouping
+        if ranked is not None:
+            heapq.heappush(best, ranked)
+            if len(best) > limit:
+                heapq.heappop(best)
+    best.sort(reverse=True)
+    return [(grouping, grouping_score) for _, grouping, grouping_score in best]
+
+
+def score_and_sort_all_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tuple[Bubble, Bubble]]]:
     """
+    `score_and_sort_bubbles` by scoring every pair of bubbles and sorting them all; kept
+    as the reference it is checked against.
+
     Given a set of bubbles, returns a sorted list of (tuples of) bubbles, sorted by a score on how
     likely the bubble(s) is to increase the size of the grammar.
     Single bubble --> likely coalesces with existing nonterminal
@@ -141,6 +401,7 @@ def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tup
 
     bubble_lst = list(sorted(list(bubbles.values()), key=lambda x: len(x.bubbled_elems), reverse=True))
     bubble_pairs = []
+    occurrences = [sum([v for v in bubble.contexts.values()]) for bubble in bubble_lst]
 
     for i in range(len(bubble_lst)):
         first_bubble: Bubble = bubble_lst[i]
@@ -159,12 +420,11 @@ def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tup
             # Score both for similarity of context and occurrence of the bubbles
             similarity = first_bubble.context_similarity(second_bubble)
             if len(first_bubble.bubbled_elems) == 1:
-                commonness = sum([v for v in second_bubble.contexts.values()]) / 2
+                commonness = occurrences[j] / 2
             elif len(second_bubble.bubbled_elems) == 1:
-                commonness = sum([v for v in first_bubble.contexts.values()])
+                commonness = occurrences[i]
             else:
-                commonness = sum([v for v in first_bubble.contexts.values()]) / 2 + sum(
-                    [v for v in second_bubble.contexts.values()]) / 2
+                commonness = occurrences[i] / 2 + occurrences[j] / 2
 
             
             if len(second_bubble.bubbled_elems) == 1:
@@ -1,75 +1,282 @@
+import hashlib
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
 from lark import Lark
 import tempfile
 import subprocess
+import threading
+import shlex
+import importlib
+import importlib.util
+import importlib.machinery
+import select
+import shutil
+import signal
+import sys
 import os
+from oracle_cache import DiskCache, MemoryCache, TraceWriter, file_digest, input_digest, read_trace
 
 """
 This file gives  classes to use as "Oracles" in the Arvada algorithm.
+
+Input delivery
+--------------
+By default an ExternalOracle writes each input to a fresh temporary file and
+runs `ORACLE_CMD filename`. Its `input_mode` selects other ways to hand over
+the input, all of which still pass a filename:
+    file:  a fresh temporary file per query (the default)
+    stdin: the input is piped on stdin, and the filename is /dev/stdin
+    memfd: an anonymous in-memory file, passed as /proc/self/fd/N
+    tmpfs: one file per thread in /dev/shm, rewritten for each query
+The oracle must not rely on seeking in /dev/stdin in stdin mode.
+
+Batch mode
+----------
+An ExternalOracle with a `batch_size` > 1 checks the strings of a `parse_many`
+call in batches, running `ORACLE_CMD f1 f2 ... fN` once per batch. With more
+than one file, the command must write one line per file to stdout, in order,
+holding the exit code it would have returned for that file alone (0 for
+valid). With a single file it behaves like a plain oracle. Files the command
+gives no line for (e.g. because it crashed) are re-checked one at a time. The
+files of a batch are temporary files, or memfds in the memfd input mode.
+
+Worker protocol
+---------------
+An ExternalOracle may be backed by a long-lived worker process instead of
+forking the oracle command once per query. The worker reads requests from its
+stdin and writes one response line per request on its stdout:
+
+    request:  <n>\\n<n bytes of utf-8 input>
+    response: <exit status>\\n
+
+where an exit status of 0 means the input is valid, like the exit code of
+the one-shot `ORACLE_CMD filename` invocation. The worker should exit when its
+stdin is closed. `run_worker` implements the worker side for Python oracles,
+and zygote.py turns any Python oracle script into a worker.
+
+Python oracles
+--------------
+A PythonOracle calls a Python function in-process instead of running a
+command. It is specified as `module:function`, where `module` is either an
+importable module name or the path of a Python file (e.g. a generated
+`parse_<name>` script), and `function` takes the input string and returns a
+truthy value if the input is valid. Raising an exception counts as invalid.
+`make_oracle` picks the right kind of oracle for a command line argument.
+
+Traces
+------
+Any oracle can record its answers to a trace file (see `record_trace`), from
+which a ReplayOracle answers the same queries later without running anything.
 """
 
+# Number of times we restart a crashed worker before giving up on it and
+# only using the one-shot command.
+MAX_WORKER_RESTARTS = 3
+
+# Upper bound on the number of queries a speculative batch sends at once.
+MAX_SPECULATIVE_JOBS = 64
+
+INPUT_MODES = ('file', 'stdin', 'memfd', 'tmpfs')
+# Where tmpfs input files go, if it exists
+TMPFS_DIR = '/dev/shm'
+
+# The adaptive oracle timeout is TIMEOUT_LATENCY_FACTOR times the 99th
+# percentile latency of the calls made so far (the seed validations), but
+# at least MIN_ORACLE_TIMEOUT seconds.
+TIMEOUT_LATENCY_FACTOR = 10
+MIN_ORACLE_TIMEOUT = 1.0
+
+
 class ParseException(Exception):
     pass
 
-class ExternalOracle:
+class TraceMissError(Exception):
     """
-    An ExternalOracle is a wrapper around an oracle that takes the form of a shell
-    command accepting a file as input. We assume the oracle returns True if the
-    exit code is 0 (no error). If the external oracle takes >3 seconds to execute,
-    we conservatively assume the oracle returns True.
+    Raised by a ReplayOracle for a query its trace has no answer for.
     """
+    pass
+
+class Oracle:
+    """
+    Common interface of the oracles: `parse` and `parse_many` answer queries from
+    `cache_set` (a MemoryCache) when possible and otherwise call `_parse_internal`, which the
+    subclasses implement. `parse_calls` counts the queries, `real_calls` the ones
+    that missed the cache, and `time_spent` the time spent answering the latter.
+    If `disk_cache` is set (see `use_disk_cache`), it is consulted before calling
+    `_parse_internal`, and answers found there don't count as real calls.
+
+    If `trace` is set (see `record_trace`), every answer that is not served from
+    `cache_set` is appended to it.
 
-    def __init__(self, command):
+    Oracles that support it give up on a query after `timeout` seconds (None for
+    no limit) and assume the input is valid; such inputs are listed in `timeouts`.
+    `latencies` holds the duration of each real call that ran to completion.
+    """
+
+    def __init__(self, jobs=1):
         """
-        `command` is a string representing the oracle command, i.e. `command` = "readpng"
-        in the oracle call:
-            $ readpng <MY_FILE>
+        `jobs` is the number of queries `parse_many` runs concurrently.
         """
-        self.command = command
-        self.cache_set = {}
+        self.jobs = jobs
+        self.cache_set = MemoryCache()
         self.parse_calls = 0
         self.real_calls = 0
         self.time_spent = 0
+        self.disk_cache = None
+        self.trace = None
+        self.timeout = None
+        self.timeouts = []
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.executors = {}
+        self.owner_pid = os.getpid()
 
-    def _parse_internal(self, string):
+    def identity(self) -> str:
         """
-        Does the work of calling the subprocess.
+        A string identifying what this oracle accepts, used to key its answers in
+        a DiskCache. It should change whenever the oracle's verdicts might.
         """
-        self.real_calls +=1
-        FNULL = open(os.devnull, 'w')
-        f = tempfile.NamedTemporaryFile()
-        f.write(bytes(string, 'utf-8'))
-        f_name = f.name
-        f.flush()
-        try:
-            # With check = True, throws a CalledProcessError if the exit code is non-zero
-            subprocess.run([self.command, f_name], stdout=FNULL, stderr=FNULL, check=True)#, timeout=10)
-            f.close()
-            FNULL.close()
-            return True
-        except subprocess.CalledProcessError as e:
-            f.close()
-            FNULL.close()
-            return False
-        except subprocess.TimeoutExpired as e:
-            print(f"Caused timeout: {string}")
-            f.close()
-            FNULL.close()
-            return True
+        raise NotImplementedError
+
+    def use_disk_cache(self, path: str):
+        """
+        Stores and looks up the answers of this oracle in the sqlite file at `path`.
+        """
+        oracle_id = hashlib.sha256(bytes(self.identity(), 'utf-8')).hexdigest()
+        self.disk_cache = DiskCache(path, oracle_id)
+
+    def record_trace(self, path: str):
+        """
+        Records the answers of this oracle to the trace file at `path`.
+        """
+        self.trace = TraceWriter(path)
+
+    def adapt_timeout(self, factor=TIMEOUT_LATENCY_FACTOR):
+        """
+        Sets `timeout` from the latencies of the real calls so far, and returns it.
+        """
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+            self.timeout = max(MIN_ORACLE_TIMEOUT, p99 * factor)
+        return self.timeout
+
+    def kills_queries(self):
+        """
+        Whether `_parse_internal` can abandon a query through its InFlightQuery,
+        so that queries cancelled by `parse_many` stop using resources.
+        """
+        return False
+
+    def _timed_out(self, string):
+        print(f"Caused timeout: {string}")
+        with self.lock:
+            self.timeouts.append(string)
+
+    def _parse_internal(self, string, query=None):
+        """
+        Returns True if `string` is valid. `query`, if given, is the InFlightQuery
+        through which a concurrent batch may cancel this call, in which case the
+        return value is ignored. Implementations that enforce `timeout` call
+        `_timed_out` and return True when it expires.
+        """
+        raise NotImplementedError
+
+    def _query(self, string, query=None):
+        """
+        Counts and makes an uncached call to the oracle. Returns None if `query`
+        was cancelled before the call started.
+        """
+        if query is not None and query.cancelled:
+            return None
+        res = self._stored_answer(string)
+        if res is not None:
+            return res
+        with self.lock:
+            self.real_calls +=1
+        s = time.time()
+        res = self._parse_internal(string, query)
+        latency = time.time() - s
+        if res is not None and not (query is not None and query.cancelled):
+            # Calls cut short by a cancellation or the timeout would bias `adapt_timeout` low
+            if string not in self.timeouts:
+                with self.lock:
+                    self.latencies.append(latency)
+            self._store_answer(string, res)
+        return res
+
+    def _stored_answer(self, string):
+        """
+        The answer to `string` from the disk cache, or None.
+        """
+        if self.disk_cache is None:
+            return None
+        res = self.disk_cache.get(string)
+        if res is not None and self.trace is not None:
+            self.trace.write(string, res)
+        return res
+
+    def _store_answer(self, string, res):
+        """
+        Keeps the oracle's answer to `string` in the disk cache and trace, if any.
+        """
+        # Verdicts assumed after a timeout depend on the deadline, so don't keep them
+        if self.disk_cache is not None and string not in self.timeouts:
+            self.disk_cache.put(string, res)
+        if self.trace is not None:
+            self.trace.write(string, res)
 
-    def parse(self, string, timeout=3):
+    def _check_owner(self):
         """
-        Caching wrapper around _parse_internal
+        A forked copy of this oracle must not share the parent's threads, so drop
+        them and start afresh.
+        """
+        if self.owner_pid != os.getpid():
+            self.lock = threading.Lock()
+            self.executors = {}
+            self.owner_pid = os.getpid()
+
+    def _executor(self, width):
+        """
+        The job pool running `width` queries at once, shared by the calls with that width.
+        """
+        self._check_owner()
+        with self.lock:
+            if width not in self.executors:
+                self.executors[width] = ThreadPoolExecutor(max_workers=width)
+            return self.executors[width]
+
+    def close(self):
+        """
+        Shuts down the job pools and the disk cache, if any.
+        """
+        if self.owner_pid != os.getpid():
+            return
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors = {}
+        if self.disk_cache is not None:
+            self.disk_cache.close()
+        if self.trace is not None:
+            self.trace.close()
+
+    def parse(self, string):
+        """
+        Caching wrapper around _parse_internal. Returns True if `string` is valid,
+        and raises a ParseException otherwise.
         """
         self.parse_calls += 1
-        if string in self.cache_set:
-            if self.cache_set[string]:
+        cached = self.cache_set.lookup(string)
+        if cached is not None:
+            if cached:
                 return True
             else:
                 raise ParseException(f"doesn't parse: {string}")
         else:
             s = time.time()
-            res = self._parse_internal(string)
+            res = self._query(string)
             self.time_spent += time.time() - s
             self.cache_set[string] = res
             if res:
@@ -77,27 +284,706 @@ class ExternalOracle:
             else:
                 raise ParseException(f"doesn't parse: {string}")
 
-class CachingOracle:
+    def parse_many(self, strings: List[str], fail_fast=True, speculative=False) -> List[Optional[bool]]:
+        """
+        Batched version of `parse`: returns a list with the verdict for each string in
+        `strings`, running up to `self.jobs` uncached queries concurrently. Duplicate
+        strings are only queried once.
+
+        If `fail_fast` is set, the batch stops at the first rejected string (in the
+        order of `strings`), and the verdicts of the strings after it are None. Oracle
+        processes still running for those strings are killed, and queries that
+        happened to finish anyway are not cached, so the cache and `parse_calls` end
+        up exactly as after calling `parse` on each string in turn.
+
+        If `speculative` is set and the oracle `kills_queries`, all uncached strings (up
+        to MAX_SPECULATIVE_JOBS) are sent to the oracle at once rather than `self.jobs`
+        at a time, which gets to a rejection sooner when most batches contain one.
+        Other oracles would have to run the cancelled queries to the end, so they keep
+        to `self.jobs`.
+
+        Several threads may call `parse_many` at once; each call then runs its own
+        `self.jobs` queries.
+        """
+        verdicts = [None] * len(strings)
+        # Index of the first rejection, and the first position of each uncached string
+        cutoff = len(strings)
+        to_query = {}
+        # Verdicts by string, so later occurrences don't depend on what the cache evicts
+        answers = {}
+        with self.lock:
+            for idx, string in enumerate(strings):
+                if string in answers or string in to_query:
+                    continue
+                cached = self.cache_set.lookup(string, count=False)
+                if cached is not None:
+                    answers[string] = cached
+                    if fail_fast and not cached:
+                        cutoff = idx
+                        break
+                else:
+                    to_query[string] = idx
+
+        if to_query:
+            s = time.time()
+            if speculative and self.kills_queries():
+                width = min(max(len(to_query), self.jobs), MAX_SPECULATIVE_JOBS)
+            else:
+                width = self.jobs
+            results = self._query_many(to_query, cutoff if fail_fast else None, width)
+            if fail_fast:
+                rejected = [idx for string, idx in to_query.items() if string in results and not results[string]]
+                cutoff = min([cutoff] + rejected)
+            with self.lock:
+                self.time_spent += time.time() - s
+                for string, idx in to_query.items():
+                    if idx <= cutoff and string in results:
+                        self.cache_set[string] = results[string]
+                        answers[string] = results[string]
+
+        answered = min(cutoff + 1, len(strings)) if fail_fast else len(strings)
+        # Fill in repeated occurrences of the strings we queried
+        for idx in range(answered):
+            verdicts[idx] = answers[strings[idx]]
+        # Count hits and misses as if the strings up to the cutoff were parsed in turn
+        misses = sum(1 for idx in to_query.values() if idx < answered)
+        with self.lock:
+            self.cache_set.record(answered - misses, misses)
+            self.parse_calls += answered
+        return verdicts
+
+    def _query_many(self, to_query, cutoff, width):
+        """
+        Runs the oracle on each string in `to_query` (a map of string -> position in
+        the batch) with `width` queries in flight, returning a map of string -> verdict.
+        If `cutoff` is not None, strings positioned after the first rejection (or after
+        `cutoff`) are skipped, or killed if already running.
+        """
+        results = {}
+        queue = sorted(to_query, key=lambda string: to_query[string])
+        if width <= 1:
+            for string in queue:
+                if cutoff is not None and to_query[string] > cutoff:
+                    break
+                results[string] = self._query(string)
+                if cutoff is not None and not results[string]:
+                    cutoff = to_query[string]
+            return results
+
+        executor = self._executor(width)
+        queries = {string: InFlightQuery() for string in queue
+                   if cutoff is None or to_query[string] <= cutoff}
+        futures = {executor.submit(self._query, string, query): string
+                   for string, query in queries.items()}
+        not_done = set(futures)
+        while not_done:
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+            for future in done:
+                string = futures[future]
+                if future.cancelled() or queries[string].cancelled:
+                    continue
+                results[string] = future.result()
+                if cutoff is not None and not results[string] and to_query[string] < cutoff:
+                    cutoff = to_query[string]
+            if cutoff is not None:
+                # Queries after the first rejection can't change the outcome
+                for future in list(not_done):
+                    string = futures[future]
+                    if to_query[string] > cutoff:
+                        future.cancel()
+                        queries[string].cancel()
+                        not_done.discard(future)
+        return results
+
+
+class ExternalOracle(Oracle):
+    """
+    An ExternalOracle is a wrapper around an oracle that takes the form of a shell
+    command accepting a file as input. We assume the oracle returns True if the
+    exit code is 0 (no error). If the external oracle takes longer than `timeout`
+    seconds to execute, we kill it and conservatively assume it returns True.
+    """
+
+    def __init__(self, command, worker_command=None, jobs=1, timeout=None, input_mode='file', batch_size=0):
+        """
+        `command` is a string representing the oracle command, i.e. `command` = "readpng"
+        in the oracle call:
+            $ readpng <MY_FILE>
+        `worker_command`, if given, is a shell-style command line for a long-lived
+        worker speaking the protocol described at the top of this file. It is started
+        once (per job) and used for every query; `command` is only used if the worker fails.
+        `jobs` is the number of oracle processes `parse_many` runs concurrently.
+        `timeout` is the initial deadline for a query in seconds (see `adapt_timeout`).
+        `input_mode` is one of INPUT_MODES, described at the top of this file.
+        `batch_size`, if > 1, enables the batch mode described at the top of this file.
+        """
+        super().__init__(jobs)
+        if input_mode not in INPUT_MODES:
+            raise ValueError(f"Unknown input mode {input_mode}, expected one of {INPUT_MODES}")
+        if input_mode == 'memfd' and not hasattr(os, 'memfd_create'):
+            raise ValueError("memfd input mode isn't supported on this platform")
+        self.timeout = timeout
+        self.input_mode = input_mode
+        self.batch_size = batch_size
+        # Shared by every oracle process as its stdout and stderr
+        self.devnull = os.open(os.devnull, os.O_WRONLY)
+        self.input_paths = []
+        self.command = command
+        self.worker_command = worker_command
+        self.workers = []
+        self.worker_restarts = 0
+        self.local = threading.local()
+
+    def identity(self):
+        # Identify the oracle by its binary too, so rebuilding it invalidates stored answers
+        binary = shutil.which(self.command)
+        return f"external:{self.command}:{file_digest(binary) if binary else ''}"
+
+    def kills_queries(self):
+        # Only one-shot processes can be killed; workers and batches see each query through
+        return self.worker_command is None and self.batch_size <= 1
+
+    def _parse_internal(self, string, query=None):
+        """
+        Does the work of calling the subprocess.
+        """
+        if self.worker_command is not None:
+            res = self._parse_worker(string)
+            if res is not None:
+                return res
+        return self._parse_oneshot(string, query)
+
+    def _parse_oneshot(self, string, query=None):
+        """
+        Runs `self.command` on `string`, delivered according to `self.input_mode`.
+        """
+        data = bytes(string, 'utf-8')
+        stdin_data = None
+        pass_fds = ()
+        f = None
+        fd = None
+        if self.input_mode == 'file':
+            f = tempfile.NamedTemporaryFile()
+            f.write(data)
+            f.flush()
+            f_name = f.name
+        elif self.input_mode == 'stdin':
+            stdin_data = data
+            f_name = '/dev/stdin'
+        elif self.input_mode == 'memfd':
+            fd = os.memfd_create('oracle-input')
+            os.write(fd, data)
+            pass_fds = (fd,)
+            f_name = f'/proc/self/fd/{fd}'
+        else:
+            f_name = self._tmpfs_input_path()
+            with open(f_name, 'wb') as input_file:
+                input_file.write(data)
+        try:
+            # In its own process group, so that a timeout also kills its children
+            process = subprocess.Popen([self.command, f_name], stdout=self.devnull, stderr=self.devnull,
+                                       stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL,
+                                       pass_fds=pass_fds, start_new_session=True)
+            if query is not None and not query.attach(process):
+                kill_process_group(process)
+            try:
+                if stdin_data is not None:
+                    process.communicate(stdin_data, timeout=self.timeout)
+                returncode = process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired as e:
+                kill_process_group(process)
+                process.wait()
+                if query is not None and query.cancelled:
+                    return None
+                self._timed_out(string)
+                return True
+            if query is not None and query.cancelled:
+                return None
+            return returncode == 0
+        finally:
+            if f is not None:
+                f.close()
+            if fd is not None:
+                os.close(fd)
+
+    def _query_many(self, to_query, cutoff, width):
+        """
+        In batch mode, runs the oracle on batches of `batch_size` strings from
+        `to_query`, in order, up to `width` batches at a time. Batches after the
+        first rejection (if `cutoff` is not None) are skipped.
+        """
+        if self.batch_size <= 1 or self.worker_command is not None:
+            return super()._query_many(to_query, cutoff, width)
+        queue = sorted(to_query, key=lambda string: to_query[string])
+        results = {}
+        unanswered = []
+        for string in queue:
+            if cutoff is not None and to_query[string] > cutoff:
+                break
+            res = self._stored_answer(string)
+            if res is None:
+                unanswered.append(string)
+                continue
+            results[string] = res
+            if cutoff is not None and not res:
+                cutoff = to_query[string]
+        if cutoff is not None:
+            unanswered = [string for string in unanswered if to_query[string] <= cutoff]
+        batches = [unanswered[i:i + self.batch_size] for i in range(0, len(unanswered), self.batch_size)]
+
+        futures = None
+        if width > 1 and len(batches) > 1:
+            executor = self._executor(width)
+            futures = [executor.submit(self._parse_batch, batch) for batch in batches]
+        for i, batch in enumerate(batches):
+            if cutoff is not None and to_query[batch[0]] > cutoff:
+                if futures is not None:
+                    for future in futures[i:]:
+                        future.cancel()
+                break
+            verdicts = futures[i].result() if futures is not None else self._parse_batch(batch)
+            for string, res in zip(batch, verdicts):
+                results[string] = res
+                if cutoff is not None and not res:
+                    cutoff = min(cutoff, to_query[string])
+        return results
+
+    def _parse_batch(self, strings):
+        """
+        Checks all of `strings` with as few runs of `self.command` as possible, and
+        returns their verdicts.
+        """
+        with self.lock:
+            self.real_calls += len(strings)
+        s = time.time()
+        verdicts = self._run_batch(strings) if len(strings) > 1 else [None]
+        for idx, string in enumerate(strings):
+            if verdicts[idx] is None:
+                verdicts[idx] = self._parse_oneshot(string)
+        elapsed = time.time() - s
+        with self.lock:
+            self.latencies.extend([elapsed / len(strings)] * len(strings))
+        for string, res in zip(strings, verdicts):
+            self._store_answer(string, res)
+        return verdicts
+
+    def _run_batch(self, strings):
+        """
+        Runs `self.command` once on files holding each of `strings`, and returns the
+        verdicts it reports, with None for the strings it gives no verdict for.
+        """
+        fds = []
+        directory = None
+        if self.input_mode == 'memfd':
+            for string in strings:
+                fd = os.memfd_create('oracle-input')
+                os.write(fd, bytes(string, 'utf-8'))
+                fds.append(fd)
+            f_names = [f'/proc/self/fd/{fd}' for fd in fds]
+        else:
+            tmp_dir = TMPFS_DIR if self.input_mode == 'tmpfs' and os.path.isdir(TMPFS_DIR) else None
+            directory = tempfile.TemporaryDirectory(prefix='treevada-batch-', dir=tmp_dir)
+            f_names = [os.path.join(directory.name, str(idx)) for idx in range(len(strings))]
+            for f_name, string in zip(f_names, strings):
+                with open(f_name, 'wb') as f:
+                    f.write(bytes(string, 'utf-8'))
+        try:
+            process = subprocess.Popen([self.command] + f_names, stdout=subprocess.PIPE, stderr=self.devnull,
+                                       stdin=subprocess.DEVNULL, pass_fds=fds, start_new_session=True)
+            try:
+                output, _ = process.communicate(
+                    timeout=self.timeout * len(strings) if self.timeout is not None else None)
+            except subprocess.TimeoutExpired as e:
+                # Keep what it answered so far; the rest is re-checked one at a time
+                kill_process_group(process)
+                output, _ = process.communicate()
+        finally:
+            for fd in fds:
+                os.close(fd)
+            if directory is not None:
+                directory.cleanup()
+        verdicts = []
+        lines = output.split(b'\n')
+        for idx in range(len(strings)):
+            try:
+                verdicts.append(int(lines[idx]) == 0)
+            except (IndexError, ValueError):
+                verdicts.append(None)
+        return verdicts
+
+    def _tmpfs_input_path(self):
+        """
+        The reusable input file of the current thread, for the tmpfs input mode.
+        """
+        self._check_owner()
+        path = getattr(self.local, 'input_path', None)
+        if path is None:
+            directory = TMPFS_DIR if os.path.isdir(TMPFS_DIR) else tempfile.gettempdir()
+            handle, path = tempfile.mkstemp(prefix='treevada-oracle-', dir=directory)
+            os.close(handle)
+            self.local.input_path = path
+            with self.lock:
+                self.input_paths.append(path)
+        return path
+
+    def _check_owner(self):
+        """
+        A forked copy of this oracle must not share the parent's worker pipes or
+        threads, so drop them and start afresh.
+        """
+        if self.owner_pid != os.getpid():
+            self.workers = []
+            self.input_paths = []
+            self.local = threading.local()
+            super()._check_owner()
+
+    def _start_worker(self):
+        """
+        Starts a long-lived worker for the current thread, unless workers have
+        crashed too often already.
+        """
+        if self.worker_restarts > MAX_WORKER_RESTARTS:
+            return None
+        worker = subprocess.Popen(shlex.split(self.worker_command), stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  start_new_session=True)
+        self.local.worker = worker
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def _parse_worker(self, string):
+        """
+        Sends `string` to this thread's long-lived worker and returns its verdict, or
+        None if the worker could not answer (in which case it is killed, and restarted
+        on the next call).
+        """
+        self._check_owner()
+        worker = getattr(self.local, 'worker', None)
+        if worker is None or worker.poll() is not None:
+            try:
+                worker = self._start_worker()
+            except OSError as e:
+                print(f"Couldn't start oracle worker: {e}", file=sys.stderr)
+                self.worker_restarts = MAX_WORKER_RESTARTS + 1
+                return None
+            if worker is None:
+                return None
+        data = bytes(string, 'utf-8')
+        try:
+            worker.stdin.write(b'%d\n' % len(data) + data)
+            worker.stdin.flush()
+            if self.timeout is not None and not select.select([worker.stdout], [], [], self.timeout)[0]:
+                # The worker is stuck on this input: replace it, and treat the input like
+                # a one-shot timeout
+                self._stop_worker(worker)
+                self.local.worker = None
+                self._timed_out(string)
+                return True
+            response = worker.stdout.readline()
+            return int(response) == 0
+        except (OSError, ValueError) as e:
+            print(f"Oracle worker failed, falling back to {self.command}", file=sys.stderr)
+            self._stop_worker(worker)
+            self.local.worker = None
+            self.worker_restarts += 1
+            return None
+
+    def _stop_worker(self, worker):
+        try:
+            worker.stdin.close()
+        except OSError:
+            pass
+        kill_process_group(worker)
+        worker.wait()
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def close(self):
+        """
+        Shuts down the long-lived workers and the job pool, if any.
+        """
+        if self.owner_pid != os.getpid():
+            return
+        super().close()
+        for worker in list(self.workers):
+            self._stop_worker(worker)
+        for path in self.input_paths:
+            os.remove(path)
+        self.input_paths = []
+        if self.devnull is not None:
+            os.close(self.devnull)
+            self.devnull = None
+        self.local = threading.local()
+
+class InFlightQuery:
+    """
+    Handle on one query of a batch, through which the batch can kill the oracle
+    process answering it once its answer is no longer needed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.process = None
+
+    def attach(self, process):
+        """
+        Records the process answering this query. Returns False if the query was
+        cancelled in the meantime, in which case the caller should kill it.
+        """
+        with self.lock:
+            self.process = process
+            return not self.cancelled
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.process is not None and self.process.poll() is None:
+                kill_process_group(self.process)
+
+
+def kill_process_group(process):
+    """
+    Kills `process` and everything else in its process group (it should have
+    been started with `start_new_session=True`).
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+class CachingOracle(Oracle):
     """
     Wraps a "Lark" parser object to provide caching of previous calls.
     """
 
     def __init__(self, oracle: Lark):
+        super().__init__()
         self.oracle = oracle
-        self.cache_set = {}
-        self.parse_calls = 0
 
-    def parse(self, string):
-        self.parse_calls += 1
-        if string in self.cache_set:
-            if self.cache_set[string]:
-                return True
-            else:
-                raise ParseException("doesn't parse")
+    def identity(self):
+        return f"lark:{self.oracle.source_grammar}"
+
+    def _parse_internal(self, string, query=None):
+        try:
+            self.oracle.parse(string)
+            return True
+        except Exception as e:
+            return False
+
+
+class PythonOracle(Oracle):
+    """
+    Calls a Python function on each query instead of running a command, which
+    saves the interpreter startup and parser construction on every query. See
+    the top of this file for the `module:function` spec.
+    """
+
+    def __init__(self, spec, jobs=1, processes=0):
+        """
+        `spec` is the `module:function` spec of the oracle function.
+        `processes`, if nonzero, is the size of a process pool the function is
+        called in, which protects the search from oracles that crash or leak state.
+        Otherwise the function is called in this process, one query at a time.
+        """
+        super().__init__(jobs if processes else 1)
+        self.spec = spec
+        self.processes = processes
+        self.function = load_oracle_function(spec)
+        self.pool = None
+        # Serializes in-process calls, as the function need not be thread-safe
+        self.call_lock = threading.Lock()
+
+    def identity(self):
+        module_name = self.spec.rsplit(':', 1)[0]
+        if os.path.isfile(module_name):
+            source = module_name
         else:
+            source = getattr(sys.modules.get(self.function.__module__), '__file__', None)
+        return f"python:{self.spec}:{file_digest(source) if source else ''}"
+
+    def _parse_internal(self, string, query=None):
+        if self.processes:
+            self._check_owner()
+            pool = self._process_pool()
             try:
-                self.oracle.parse(string)
-                self.cache_set[string] = True
-            except Exception as e:
-                self.cache_set[string] = False
-                raise ParseException("doesn't parse")
+                return pool.submit(_call_pool_oracle, string).result()
+            except BrokenProcessPool:
+                self._replace_pool(pool)
+            # A crash fails every query in the pool, so retry this one on its own to
+            # tell whether it is the input that crashes the oracle
+            isolated = ProcessPoolExecutor(max_workers=1, initializer=_init_pool_oracle, initargs=(self.spec,))
+            try:
+                return isolated.submit(_call_pool_oracle, string).result()
+            except BrokenProcessPool:
+                return False
+            finally:
+                isolated.shutdown(wait=False)
+        with self.call_lock:
+            return _call_oracle_function(self.function, string)
+
+    def _process_pool(self):
+        """
+        The process pool, started on first use. Concurrent `parse_many` calls share it.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_pool_oracle,
+                                                initargs=(self.spec,))
+            return self.pool
+
+    def _replace_pool(self, broken):
+        """
+        Drops `broken`, a pool whose process died, so that the next query starts a new one.
+        """
+        with self.lock:
+            if self.pool is broken:
+                self.pool = None
+        broken.shutdown(wait=False)
+
+    def _check_owner(self):
+        if self.owner_pid != os.getpid():
+            self.pool = None
+            super()._check_owner()
+
+    def close(self):
+        """
+        Shuts down the process pool and the job pools, if any.
+        """
+        if self.owner_pid != os.getpid():
+            return
+        super().close()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class ReplayOracle(Oracle):
+    """
+    Answers queries from a trace recorded by `Oracle.record_trace`, without
+    running any oracle. Raises a TraceMissError on a query the trace doesn't
+    answer, since that means the run has diverged from the recorded one.
+    """
+
+    def __init__(self, path, jobs=1):
+        super().__init__(jobs)
+        self.path = path
+        self.verdicts = read_trace(path)
+
+    def identity(self):
+        return f"replay:{file_digest(self.path)}"
+
+    def _parse_internal(self, string, query=None):
+        try:
+            return self.verdicts[input_digest(string)]
+        except KeyError:
+            raise TraceMissError(f"no answer in trace {self.path} for: {repr(string)}")
+
+
+def is_python_oracle_spec(spec: str):
+    """
+    Returns True if `spec` looks like a `module:function` spec rather than a command.
+    >>> is_python_oracle_spec("text-paren-example/parser.py:accepts")
+    True
+    >>> is_python_oracle_spec("json.decoder:JSONDecoder")
+    True
+    >>> is_python_oracle_spec("text-paren-example/parser.py")
+    False
+    """
+    if os.path.exists(spec) or ':' not in spec:
+        return False
+    module, function = spec.rsplit(':', 1)
+    return bool(module) and function.isidentifier()
+
+
+def load_oracle_function(spec: str):
+    """
+    Imports the function named by the `module:function` spec `spec`.
+    """
+    module_name, function_name = spec.rsplit(':', 1)
+    if os.path.isfile(module_name):
+        # Also accept scripts without a .py extension, like the generated parse_<name>
+        name = os.path.splitext(os.path.basename(module_name))[0].replace('-', '_')
+        loader = importlib.machinery.SourceFileLoader(name, module_name)
+        module_spec = importlib.util.spec_from_loader(name, loader)
+        module = importlib.util.module_from_spec(module_spec)
+        loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def _call_oracle_function(function, string):
+    try:
+        return bool(function(string))
+    except Exception:
+        return False
+
+
+# The oracle function of a PythonOracle pool process
+_pool_oracle_function = None
+
+
+def _init_pool_oracle(spec):
+    global _pool_oracle_function
+    _pool_oracle_function = load_oracle_function(spec)
+
+
+def _call_pool_oracle(string):
+    return _call_oracle_function(_pool_oracle_function, string)
+
+
+def make_oracle(oracle_cmd, worker_cmd=None, jobs=1, processes=0, cache_file=None, cache_budget=None,
+                timeout=None, record_file=None, replay_file=None, input_mode='file', batch_size=0,
+                zygote=False) -> Oracle:
+    """
+    Makes the oracle for the `oracle_cmd` command line argument: a PythonOracle
+    if it is a `module:function` spec, an ExternalOracle otherwise. If
+    `cache_file` is given, the oracle's answers are kept in that sqlite file.
+    `cache_budget`, if given, bounds the size in bytes of the in-memory cache.
+    `timeout`, `input_mode` and `batch_size` configure an ExternalOracle.
+    If `zygote` is set, `oracle_cmd` must be a Python script, and its worker is a
+    zygote.py server for it rather than `worker_cmd`.
+    If `replay_file` is given, `oracle_cmd` is ignored and the oracle's answers
+    come from that trace instead; if `record_file` is given, they are recorded
+    to that trace.
+    """
+    if replay_file is not None:
+        oracle = ReplayOracle(replay_file, jobs)
+    elif is_python_oracle_spec(oracle_cmd):
+        oracle = PythonOracle(oracle_cmd, jobs, processes)
+    else:
+        if zygote:
+            zygote_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zygote.py')
+            worker_cmd = ' '.join(shlex.quote(arg) for arg in [sys.executable, zygote_script, oracle_cmd])
+        oracle = ExternalOracle(oracle_cmd, worker_cmd, jobs, timeout, input_mode, batch_size)
+    oracle.cache_set.budget = cache_budget
+    if cache_file is not None:
+        oracle.use_disk_cache(cache_file)
+    if record_file is not None:
+        oracle.record_trace(record_file)
+    return oracle
+
+
+def run_worker(accepts):
+    """
+    Serves the worker protocol on stdin/stdout. `accepts` is called on each input
+    string and should return True if the input is valid; raising an exception
+    counts as invalid.
+    """
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        header = stdin.readline()
+        if not header:
+            return
+        data = stdin.read(int(header))
+        try:
+            ok = accepts(data.decode('utf-8'))
+        except Exception:
+            ok = False
+        stdout.write(b'0\n' if ok else b'1\n')
+        stdout.flush()
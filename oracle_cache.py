@@ -0,0 +1,234 @@
+import hashlib
+import sqlite3
+import sys
+from collections import OrderedDict
+import threading
+import os
+
+"""
+Caches for oracle answers that outlive a single in-memory Oracle, and traces
+of the answers of a run for replaying it without the oracle.
+"""
+
+# Rough number of bytes one entry of a MemoryCache takes up: the 16-byte digest
+# object plus its slot and links in the OrderedDict.
+MEMORY_CACHE_ENTRY_BYTES = sys.getsizeof(bytes(16)) + 100
+
+# Share of a full MemoryCache kept for positive answers when evicting, so that
+# they are not all pushed out by negative ones.
+MEMORY_CACHE_POSITIVE_SHARE = 0.25
+
+# First line of a trace file; the rest are TRACE_RECORD_SIZE-byte records of
+# an input digest followed by a verdict byte.
+TRACE_HEADER = b'treevada-trace 1\n'
+TRACE_RECORD_SIZE = 17
+
+# Seconds a connection waits for another process's write lock before failing.
+DISK_CACHE_LOCK_TIMEOUT = 60
+
+
+def input_digest(string: str) -> bytes:
+    """
+    Fixed-size key for an oracle input.
+    >>> len(input_digest("ppnpp"))
+    16
+    >>> input_digest("n") == input_digest("n"), input_digest("n") == input_digest("p")
+    (True, False)
+    """
+    return hashlib.blake2b(bytes(string, 'utf-8'), digest_size=16).digest()
+
+
+def file_digest(path: str) -> str:
+    """
+    Hex digest of the contents of the file at `path`.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MemoryCache:
+    """
+    In-memory store of oracle verdicts keyed by input digest, so that an entry
+    costs the same however long the input is. If `budget` (in bytes) is given,
+    least recently used entries are evicted once the cache outgrows it. Positive
+    answers are evicted before negative ones, down to MEMORY_CACHE_POSITIVE_SHARE
+    of the cache: coalescing re-checks the same rejected candidates again and
+    again, while most accepted strings are only seen a few times.
+
+    `hits`, `misses` and `evictions` count lookups and evicted entries.
+
+    >>> cache = MemoryCache(budget=4 * MEMORY_CACHE_ENTRY_BYTES)
+    >>> for s in "abcde": cache[s] = s in "bd"
+    >>> [cache.lookup(s) for s in "abcde"]
+    [False, None, False, True, False]
+    >>> cache["f"] = False
+    >>> [cache.lookup(s) for s in "acdef"]
+    [None, False, True, False, False]
+    >>> cache.stats()['CACHE_EVICTIONS'], len(cache)
+    (2, 4)
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.positives = OrderedDict()
+        self.negatives = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, string: str, count=True):
+        """
+        Returns the stored verdict for `string`, or None if there is none. If
+        `count` is False the caller counts the hit or miss itself (see `record`).
+        """
+        digest = input_digest(string)
+        for entries, verdict in ((self.negatives, False), (self.positives, True)):
+            if digest in entries:
+                entries.move_to_end(digest)
+                self.hits += count
+                return verdict
+        self.misses += count
+        return None
+
+    def record(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+
+    def __contains__(self, string: str):
+        digest = input_digest(string)
+        return digest in self.negatives or digest in self.positives
+
+    def __setitem__(self, string: str, valid: bool):
+        digest = input_digest(string)
+        self.positives.pop(digest, None)
+        self.negatives.pop(digest, None)
+        (self.positives if valid else self.negatives)[digest] = None
+        if self.budget is not None:
+            while len(self) * MEMORY_CACHE_ENTRY_BYTES > self.budget and len(self) > 1:
+                if len(self.positives) > MEMORY_CACHE_POSITIVE_SHARE * len(self) or not self.negatives:
+                    self.positives.popitem(last=False)
+                else:
+                    self.negatives.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.positives) + len(self.negatives)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'CACHE_ENTRIES': len(self), 'CACHE_BYTES': len(self) * MEMORY_CACHE_ENTRY_BYTES,
+                'CACHE_HIT_RATE': self.hits / lookups if lookups else 0, 'CACHE_EVICTIONS': self.evictions}
+
+
+class DiskCache:
+    """
+    An sqlite-backed store of oracle verdicts, shared across runs and between
+    the processes and threads of one run. Answers are keyed by `oracle_id`, which
+    identifies the oracle (see Oracle.identity), and by the digest of the input,
+    so one file may hold the answers of several oracles.
+
+    `hits` and `misses` count the lookups that did and did not find an answer.
+    """
+
+    def __init__(self, path: str, oracle_id: str):
+        self.path = path
+        self.oracle_id = oracle_id
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.owner_pid = os.getpid()
+        conn = self._connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS answers "
+                         "(oracle TEXT NOT NULL, digest BLOB NOT NULL, valid INTEGER NOT NULL, "
+                         "PRIMARY KEY (oracle, digest)) WITHOUT ROWID")
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        sqlite connections must not be shared between threads or across a fork, so
+        each thread of each process opens its own.
+        """
+        if self.owner_pid != os.getpid():
+            self.lock = threading.Lock()
+            self.local = threading.local()
+            self.owner_pid = os.getpid()
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DISK_CACHE_LOCK_TIMEOUT)
+            # WAL lets readers proceed while another process writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, string: str):
+        """
+        Returns the stored verdict for `string`, or None if there is none.
+        """
+        row = self._connection().execute("SELECT valid FROM answers WHERE oracle = ? AND digest = ?",
+                                         (self.oracle_id, input_digest(string))).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else bool(row[0])
+
+    def put(self, string: str, valid: bool):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)",
+                         (self.oracle_id, input_digest(string), int(valid)))
+
+    def stats(self):
+        return {'DISK_CACHE_HITS': self.hits, 'DISK_CACHE_MISSES': self.misses}
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.owner_pid == os.getpid():
+            conn.close()
+        self.local = threading.local()
+
+
+class TraceWriter:
+    """
+    Appends the verdicts of an oracle to a trace file, in the order they are
+    given. The file is created (or truncated) on construction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_HEADER)
+        self.records = 0
+
+    def write(self, string: str, valid: bool):
+        with self.lock:
+            self.file.write(input_digest(string) + (b'\x01' if valid else b'\x00'))
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def read_trace(path: str):
+    """
+    Returns a map of input digest -> verdict from the trace file at `path`.
+    """
+    with open(path, 'rb') as f:
+        if f.readline() != TRACE_HEADER:
+            raise ValueError(f"{path} is not an oracle trace")
+        data = f.read()
+    if len(data) % TRACE_RECORD_SIZE:
+        raise ValueError(f"{path} is truncated")
+    verdicts = {}
+    for start in range(0, len(data), TRACE_RECORD_SIZE):
+        verdicts[data[start:start + 16]] = data[start + 16] == 1
+    return verdicts
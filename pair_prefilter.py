@@ -0,0 +1,156 @@
+from typing import Dict, List, Tuple
+
+from group import is_balanced
+from parse_tree import ParseNode
+
+"""
+Cheap per-nonterminal signatures used to rank and prune the nonterminal pairs
+tried in a coalesce, before any candidate strings are generated or any oracle
+query is made.
+"""
+
+
+def char_class(char: str) -> str:
+    """
+    Class of a character in a signature's profile: letters, digits and whitespace
+    are lumped together, punctuation stands for itself.
+    >>> [char_class(c) for c in "aZ7 \\t(;"]
+    ['a', 'a', 'd', 's', 's', '(', ';']
+    """
+    if char.isalpha():
+        return 'a'
+    if char.isdigit():
+        return 'd'
+    if char.isspace():
+        return 's'
+    return char
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class Signature:
+    """
+    Summary of the strings a nonterminal derives in the trees: the range of their
+    lengths, whether they have balanced brackets, the character classes they
+    contain, and the contexts (previous and next character of the example) they
+    occur in.
+    """
+
+    def __init__(self):
+        self.min_len = None
+        self.max_len = 0
+        self.balance = set()
+        self.classes = set()
+        self.contexts = set()
+
+    def add(self, derived: str, context: Tuple[str, str]):
+        self.min_len = len(derived) if self.min_len is None else min(self.min_len, len(derived))
+        self.max_len = max(self.max_len, len(derived))
+        self.balance.add(bool(is_balanced(derived)))
+        self.classes.update(char_class(c) for c in derived)
+        self.contexts.add(context)
+
+    def update(self, other: 'Signature'):
+        """
+        Makes this the signature of the union of both nonterminals' strings.
+        """
+        if other.min_len is not None:
+            self.min_len = other.min_len if self.min_len is None else min(self.min_len, other.min_len)
+        self.max_len = max(self.max_len, other.max_len)
+        self.balance |= other.balance
+        self.classes |= other.classes
+        self.contexts |= other.contexts
+
+    def compatible(self, other: 'Signature') -> bool:
+        """
+        False if a merge of the two nonterminals is very unlikely to be accepted:
+        one derives only strings with balanced brackets and the other only strings
+        without, or they share neither a character class nor a context.
+        """
+        if len(self.balance) == 1 and len(other.balance) == 1 and self.balance != other.balance:
+            return False
+        return bool(self.classes & other.classes) or bool(self.contexts & other.contexts)
+
+    def similarity(self, other: 'Signature') -> float:
+        """
+        Score in [0, 3] of how alike the two signatures are; more alike pairs are
+        more likely to merge.
+        """
+        lo = max(self.min_len or 0, other.min_len or 0)
+        hi = min(self.max_len, other.max_len)
+        span = max(self.max_len, other.max_len) - min(self.min_len or 0, other.min_len or 0)
+        length_overlap = 1.0 if span == 0 else max(hi - lo, 0) / span
+        return jaccard(self.classes, other.classes) + jaccard(self.contexts, other.contexts) + length_overlap
+
+
+class PairPrefilter:
+    """
+    Index of the Signature of every nonterminal in a list of parse trees.
+
+    >>> a = ParseNode('t1', False, [ParseNode('a', True, [])])
+    >>> b = ParseNode('t2', False, [ParseNode('b', True, [])])
+    >>> lp = ParseNode('t3', False, [ParseNode('(', True, [])])
+    >>> rp = ParseNode('t4', False, [ParseNode(')', True, [])])
+    >>> prefilter = PairPrefilter([ParseNode('t0', False, [lp, a, rp]), ParseNode('t0', False, [lp, b, rp])])
+    >>> prefilter.compatible('t1', 't2'), prefilter.compatible('t1', 't3'), prefilter.compatible('t3', 't4')
+    (True, False, False)
+    >>> prefilter.order([('t1', 't3'), ('t3', 't4'), ('t1', 't2')])
+    [('t1', 't2'), ('t1', 't3'), ('t3', 't4')]
+    >>> prefilter.merge('t1', 't3', 't5')
+    >>> prefilter.compatible('t5', 't2')
+    True
+    """
+
+    def __init__(self, trees: List[ParseNode]):
+        self.signatures: Dict[str, Signature] = {}
+        for tree in trees:
+            self._index_tree(tree)
+
+    def _index_tree(self, tree: ParseNode):
+        example = tree.derived_string()
+
+        def index_node(node: ParseNode, start: int) -> int:
+            """
+            Indexes `node`, whose string starts at `start` in the example, and its
+            descendants. Returns the position just after the node's string.
+            """
+            if node.is_terminal:
+                return start + len(node.derived_string())
+            end = start
+            for child in node.children:
+                end = index_node(child, end)
+            context = (example[start - 1] if start > 0 else '', example[end] if end < len(example) else '')
+            self.signatures.setdefault(node.payload, Signature()).add(example[start:end], context)
+            return end
+
+        index_node(tree, 0)
+
+    def compatible(self, first: str, second: str) -> bool:
+        if first not in self.signatures or second not in self.signatures:
+            return True
+        return self.signatures[first].compatible(self.signatures[second])
+
+    def similarity(self, first: str, second: str) -> float:
+        if first not in self.signatures or second not in self.signatures:
+            return 0.0
+        return self.signatures[first].similarity(self.signatures[second])
+
+    def order(self, pairs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Returns `pairs` with the most alike first. Ties keep their order.
+        """
+        return sorted(pairs, key=lambda pair: -self.similarity(*pair))
+
+    def merge(self, first: str, second: str, class_nt: str):
+        """
+        Records that `first` and `second` were merged into `class_nt`.
+        """
+        merged = Signature()
+        for nt in (first, second):
+            if nt in self.signatures:
+                merged.update(self.signatures.pop(nt))
+        self.signatures[class_nt] = merged
@@ -1,7 +1,8 @@
 import functools
+import itertools
 import random
 from collections import defaultdict
-from typing import List, Iterable
+from typing import List, Iterable, Tuple
 
 from grammar import Rule, Grammar
 from input import clean_terminal
@@ -14,6 +15,73 @@ def fixup_terminal(payload):
     return payload
 
 
+class TreeIndex:
+    """
+    Index of the nonterminal nodes of one parse tree, filled in per nonterminal on
+    first use: `nodes(nt)` gives the (path, span, node)s of the nodes labeled `nt`,
+    and `parents(nt, body)` those of the ones whose children are labeled `body`
+    (fixed-up payloads), both in preorder. Only the subtrees in which `nt` occurs
+    are walked to find them. `outermost(nt)` gives those of the nodes labeled `nt`
+    that are not nested in another one.
+
+    Each index made gets a new `version`, so as the index of a tree is dropped when
+    the tree changes, the versions of its trees' indices tell whether a forest changed.
+
+    >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('a', True, [])]),
+    ...                                ParseNode('t1', False, [ParseNode('"b"', True, [])])])
+    >>> index = TreeIndex(tree)
+    >>> [(path, span) for path, span, _ in index.nodes('t1')]
+    [((0,), (0, 1)), ((1,), (1, 2))]
+    >>> [(path, span) for path, span, _ in index.parents('t1', ('b',))]
+    [((1,), (1, 2))]
+    >>> tree = ParseNode('t0', False, [tree, ParseNode('t0', False, [ParseNode('c', True, [])])])
+    >>> [(path, span) for path, span, _ in TreeIndex(tree).outermost('t0')]
+    [((), (0, 3))]
+    """
+    versions = itertools.count()
+
+    def __init__(self, tree: 'ParseNode'):
+        self.tree = tree
+        self.version = next(TreeIndex.versions)
+        self.nodes_by_nt = {}
+        self.parents_by_rule = {}
+        self.outermost_by_nt = {}
+
+    def nodes(self, nt: str) -> List[Tuple[Tuple[int, ...], Tuple[int, int], 'ParseNode']]:
+        if nt not in self.nodes_by_nt:
+            self.nodes_by_nt[nt] = self.__find(nt, nested=True)
+        return self.nodes_by_nt[nt]
+
+    def parents(self, nt: str, body: Tuple[str, ...]) -> List[Tuple[Tuple[int, ...], Tuple[int, int], 'ParseNode']]:
+        key = (nt, body)
+        if key not in self.parents_by_rule:
+            self.parents_by_rule[key] = [(path, span, node) for path, span, node in self.nodes(nt)
+                                         if tuple(fixup_terminal(child.payload) for child in node.children) == body]
+        return self.parents_by_rule[key]
+
+    def outermost(self, nt: str) -> List[Tuple[Tuple[int, ...], Tuple[int, int], 'ParseNode']]:
+        if nt not in self.outermost_by_nt:
+            self.outermost_by_nt[nt] = self.__find(nt, nested=False)
+        return self.outermost_by_nt[nt]
+
+    def __find(self, nt: str, nested: bool) -> List[Tuple[Tuple[int, ...], Tuple[int, int], 'ParseNode']]:
+        found = []
+
+        def visit(node: 'ParseNode', path: Tuple[int, ...], start: int):
+            if node.payload == nt:
+                found.append((path, (start, start + len(node.derived_string())), node))
+                if not nested:
+                    return
+            for idx, child in enumerate(node.children):
+                if not child.is_terminal and nt in child.all_nts():
+                    visit(child, path + (idx,), start)
+                start += len(child.derived_string())
+
+        if nt in self.tree.all_nts():
+            visit(self.tree, (), 0)
+        return found
+
+
 class ParseTreeList:
     """
     A list of parse trees, also encapsulating the grammar induced byt the parse trees.
@@ -33,24 +101,78 @@ class ParseTreeList:
         self.derivables_from_nt = defaultdict(set)
         self.__compute_derivables()
         self.derivable_cache_hash = hash(tuple(self.inner_list))
+        # nonterminal -> indices of the trees it occurs in, filled in on demand
+        self.trees_by_nt = {}
 
     def __getitem__(self, item):
         return self.inner_list[item]
 
     def __setitem__(self, key, value):
         self.inner_list[key] = value
+        self.trees_by_nt = {}
 
     def __iter__(self):
         return self.inner_list.__iter__()
 
     def append(self, value):
         self.inner_list.append(value)
+        self.trees_by_nt = {}
 
     def represented_strings(self):
         return self.derivable_in_trees('t0')
 
+    def merged(self, inner_list, grammar, get_class):
+        """
+        Returns the ParseTreeList of `inner_list`, which are the trees of this list
+        after merging nonterminals into classes as given by `get_class`, deriving
+        its derivables from ours instead of recomputing them from the trees.
+        """
+        merged = ParseTreeList()
+        merged.inner_list = inner_list
+        merged.grammar = grammar
+        for nt, derivables in self.derivables_from_nt.items():
+            merged.derivables_from_nt[get_class.get(nt, nt)].update(derivables)
+        # Hashing the trees is as costly as computing the derivables, so wait
+        # until they are first needed
+        merged.derivable_cache_hash = None
+        return merged
+
+    def __tree_idxs(self, nt: str) -> List[int]:
+        if nt not in self.trees_by_nt:
+            self.trees_by_nt[nt] = [idx for idx, tree in enumerate(self.inner_list) if nt in tree.all_nts()]
+        return self.trees_by_nt[nt]
+
+    def nonterminals(self) -> List[str]:
+        """
+        The nonterminals occurring in the trees.
+        """
+        nts = {}
+        for tree in self.inner_list:
+            nts.update(dict.fromkeys(tree.all_nts()))
+        return list(nts)
+
+    def trees_with(self, nt: str) -> List['ParseNode']:
+        """
+        The trees with a node labeled `nt`, in order.
+        """
+        return [self.inner_list[idx] for idx in self.__tree_idxs(nt)]
+
+    def trees_with_rule(self, rule_start: str, body: Iterable[str]) -> List['ParseNode']:
+        """
+        The trees with a `rule_start` node whose children are labeled `body`, in order.
+
+        >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('a', True, [])])])
+        >>> trees = ParseTreeList([ParseNode('t0', False, [ParseNode('b', True, [])]), tree])
+        >>> trees.trees_with_rule('t1', ['"a"']) == [tree], trees.trees_with_rule('t1', ['"b"'])
+        (True, [])
+        """
+        key = (rule_start, tuple(fixup_terminal(elem) for elem in body))
+        return [tree for tree in self.trees_with(rule_start) if tree.index().parents(*key)]
+
     def derivable_in_trees(self, nt):
-        if self.derivable_cache_hash != hash(tuple(self.inner_list)):
+        if self.derivable_cache_hash is None:
+            self.derivable_cache_hash = hash(tuple(self.inner_list))
+        elif self.derivable_cache_hash != hash(tuple(self.inner_list)):
             self.__compute_derivables()
             self.derivable_cache_hash = hash(tuple(self.inner_list))
         return self.derivables_from_nt.get(nt, 0)
@@ -229,14 +351,25 @@ class ParseNode():
         self.cache_valid = False
         self.cached_string = None
         self.cached_nts = None
+        self.cached_index = None
 
     def update_cache_info(self):
         for child in self.children:
             child.update_cache_info()
         self.cached_string = self.derived_string()
         self.cached_nts = self.all_nts()
+        self.cached_index = None
         self.cache_valid = True
 
+    def index(self) -> TreeIndex:
+        """
+        The TreeIndex of the tree rooted here, made on first use. Code that changes
+        the tree in place must call `update_cache_info` on it (or reset `cached_index`).
+        """
+        if self.cached_index is None:
+            self.cached_index = TreeIndex(self)
+        return self.cached_index
+
     def all_nts(self):
         if self.cache_valid:
             return self.cached_nts
@@ -0,0 +1,166 @@
+from collections import defaultdict
+from typing import Dict, List
+
+from parse_tree import ParseNode
+
+"""
+Relabeling of the parse trees after a coalesce merges nonterminals into a
+class nonterminal.
+"""
+
+
+def replace_coalesced_nonterminals(node: ParseNode, get_class: Dict[str, str]):
+    """
+    Rewrites node so that coalesced nonterminals point to their
+    class nonterminal. For non-coalesced nonterminals, get_class
+    just gives the original nonterminal
+    """
+    if node.is_terminal:
+        return
+    else:
+        node.payload = get_class.get(node.payload, node.payload)
+        for child in node.children:
+            replace_coalesced_nonterminals(child, get_class)
+
+
+def fix_double_indirection(node: ParseNode):
+    """
+    Fix parse trees that have an expansion of the for tx->tx (only one child)
+    since we've removed such double indirection while merging nonterminals
+    """
+    if node.is_terminal:
+        return
+
+    while len(node.children) == 1 and node.children[0].payload == node.payload:
+        # Won't go on forever because eventually length of children will be not 1,
+        # or the children's payload will not be the same as the top node (e.g. if
+        # the child is a terminal)
+        node.children = node.children[0].children
+
+    for child in node.children:
+        fix_double_indirection(child)
+
+
+def relabel_copying(trees: List[ParseNode], get_class: Dict[str, str]) -> List[ParseNode]:
+    """
+    Returns relabeled copies of all of `trees`, where `get_class` maps each merged
+    nonterminal to its class nonterminal.
+    """
+    new_trees = []
+    for tree in trees:
+        new_tree = tree.copy()
+        replace_coalesced_nonterminals(new_tree, get_class)
+        fix_double_indirection(new_tree)
+        new_tree.update_cache_info()
+        new_trees.append(new_tree)
+    return new_trees
+
+
+class TreeRelabeler:
+    """
+    Relabels trees for a sequence of merges like `relabel_copying`, but copies a
+    tree only the first time a merge touches it (copy-on-write), so the trees it
+    is given are never modified. Trees a merge does not touch are passed through,
+    and trees it has copied are relabeled in place afterwards.
+
+    For each tree it owns, it keeps an index from nonterminal to the nodes labeled
+    with it, so a merge only visits the merged nodes and the nodes whose cached
+    nonterminal sets mention them.
+
+    Assumes, like `relabel_copying` does after the first merge, that the trees have
+    no tx->tx expansions to begin with.
+
+    >>> leaf = lambda nt, c: ParseNode(nt, False, [ParseNode(c, True, [])])
+    >>> trees = [ParseNode('t0', False, [leaf('t1', 'a'), ParseNode('t3', False, [leaf('t2', 'b')])]),
+    ...          ParseNode('t0', False, [leaf('t4', 'c')])]
+    >>> for tree in trees: tree.update_cache_info()
+    >>> relabeler = TreeRelabeler()
+    >>> merges = [{'t1': 't5', 't2': 't5'}, {'t5': 't6', 't3': 't6'}]
+    >>> new_trees, expected = trees, trees
+    >>> for get_class in merges:
+    ...     new_trees = relabeler.relabel(new_trees, get_class)
+    ...     expected = relabel_copying(expected, get_class)
+    >>> new_trees == expected, new_trees[1] is trees[1], trees[0].children[0].payload
+    (True, True, 't1')
+    >>> sorted(new_trees[0].all_nts()), new_trees[0].children[1].children[0].payload
+    (['t0', 't6'], 'b')
+    """
+
+    def __init__(self):
+        # id(tree) -> (tree, nonterminal -> nodes) for the trees we own
+        self.owned = {}
+
+    def relabel(self, trees: List[ParseNode], get_class: Dict[str, str]) -> List[ParseNode]:
+        """
+        Returns `trees` relabeled for the merge given by `get_class`, which maps each
+        merged nonterminal to its class nonterminal.
+        """
+        new_trees = []
+        for tree in trees:
+            if not any(nt in tree.all_nts() for nt in get_class):
+                new_trees.append(tree)
+                continue
+            if id(tree) in self.owned:
+                self._relabel_owned(tree, get_class)
+            else:
+                tree = self._own(tree, get_class)
+            new_trees.append(tree)
+        return new_trees
+
+    def _own(self, tree: ParseNode, get_class: Dict[str, str]) -> ParseNode:
+        """
+        Copies `tree`, indexing the copy, and relabels the copy.
+        """
+        index = defaultdict(list)
+
+        def copy(node: ParseNode) -> ParseNode:
+            if node.is_terminal:
+                return ParseNode(node.payload, True, [])
+            new_node = ParseNode(node.payload, False, [copy(child) for child in node.children])
+            index[new_node.payload].append(new_node)
+            return new_node
+
+        new_tree = copy(tree)
+        self.owned[id(new_tree)] = (new_tree, index)
+        self._relabel_nodes(index, get_class)
+        new_tree.update_cache_info()
+        return new_tree
+
+    def _relabel_owned(self, tree: ParseNode, get_class: Dict[str, str]):
+        _, index = self.owned[id(tree)]
+        self._relabel_nodes(index, get_class)
+        # Paths and expansions may have changed; rebuilt on demand
+        tree.cached_index = None
+        merged = set(get_class)
+        classes = set(get_class.values())
+
+        def update_nts(node: ParseNode):
+            if node.is_terminal or merged.isdisjoint(node.cached_nts):
+                return
+            node.cached_nts -= merged
+            node.cached_nts |= classes
+            for child in node.children:
+                update_nts(child)
+
+        update_nts(tree)
+
+    @staticmethod
+    def _relabel_nodes(index: Dict[str, List[ParseNode]], get_class: Dict[str, str]):
+        """
+        Relabels the nodes of the merged nonterminals and removes the tx->tx
+        expansions that creates, keeping `index` up to date.
+        """
+        moved = defaultdict(list)
+        for nt, class_nt in get_class.items():
+            for node in index.pop(nt, []):
+                node.payload = class_nt
+                moved[class_nt].append(node)
+        for class_nt, nodes in moved.items():
+            removed = set()
+            for node in nodes:
+                if id(node) in removed:
+                    continue
+                while len(node.children) == 1 and node.children[0].payload == node.payload:
+                    removed.add(id(node.children[0]))
+                    node.children = node.children[0].children
+            index[class_nt].extend(node for node in nodes if id(node) not in removed)
@@ -1,14 +1,17 @@
 import functools
+import hashlib
 import itertools
 import random
 import time
-from typing import Tuple, List, Set
+from typing import Tuple, List, Set, Dict, FrozenSet
 import sys
 
 from grammar import Grammar
-from parse_tree import ParseNode, fixup_terminal
+from parse_tree import ParseNode, ParseTreeList, fixup_terminal
 REPLACE_CONST = '[[:REPLACEME]]'
 MAX_SAMPLES = 10
+# Memoize `lvl_n_derivable` across calls; see DerivableCache
+MEMOIZE_DERIVABLES = True
 
 TIME_GENERATING_EXAMPLES_INTERNAL = 0
 
@@ -28,6 +31,27 @@ def nt_in_tree(tree: ParseNode, nt: str):
     """
     return nt in tree.all_nts()
 
+
+def trees_containing(trees, nt: str):
+    """
+    The trees in `trees` in which `nt` occurs, in order. Looked up in the occurrence
+    index if `trees` is a ParseTreeList.
+    """
+    if isinstance(trees, ParseTreeList):
+        return trees.trees_with(nt)
+    return [tree for tree in trees if nt_in_tree(tree, nt)]
+
+
+def trees_containing_rule(trees, rule_start: str, body: List[str]):
+    """
+    The trees in `trees` that may have a `rule_start` node whose children are labeled
+    `body`, in order: exactly those if `trees` is a ParseTreeList, otherwise the trees
+    in which `rule_start` occurs.
+    """
+    if isinstance(trees, ParseTreeList):
+        return trees.trees_with_rule(rule_start, body)
+    return trees_containing(trees, rule_start)
+
 def get_overlaps(larger: List[str], smaller: List[str]):
     """
     ASSUMES: `smaller` is not explicitly contained in `larger`.
@@ -95,7 +119,6 @@ def muh_product(lst):
         prod *= e
     return prod
 
-#@functools.lru_cache()
 def lvl_n_derivable(trees, target_nt, n, max_samples=1000):
     """
     Get the strings that are level-n derivable from the nonterminal `target_nt` in `trees`.
@@ -141,28 +164,139 @@ def lvl_n_derivable(trees, target_nt, n, max_samples=1000):
     10
     >>> lvl_n_derivable([tree_1, tree_2], 't0', 2)
     ['3', '(3)', '((3))', '(((3)))']
+    >>> lvl_n_derivable(ParseTreeList(trees), 't0', 1) == lvl_n_derivable(trees, 't0', 1)
+    True
+    """
+    if MEMOIZE_DERIVABLES:
+        return DERIVABLE_CACHE.lookup(trees, target_nt, n, max_samples)
+    return compute_lvl_n_derivable(trees, target_nt, n, max_samples)
+
+def compute_lvl_n_derivable(trees, target_nt, n, max_samples=1000, child_derivable=None):
+    """
+    `lvl_n_derivable` without the cache (at this level), getting the strings of the
+    children from `child_derivable`, `lvl_n_derivable` by default.
     """
+    child_derivable = child_derivable or lvl_n_derivable
     # switching from set() to list() for deterministic order of elements
     ret_strs = []
-    for tree in trees:
-        def process_tree(tree: ParseNode):
-             if tree.payload == target_nt:
-                nonlocal ret_strs
-                if n == 0 or tree.is_terminal:
-                    ret_strs.append(tree.derived_string())
-                else:
-                    child_strs = [lvl_n_derivable(trees, c.payload, n-1, max_samples) for c in tree.children]
-                    ret_strs.extend(sample_from_product_ext(child_strs, max_samples))
-                ret_strs = list(dict.fromkeys(ret_strs))
-             else:
-                 for c in tree.children:
-                    process_tree(c)
-        process_tree(tree)
+    for tree in trees_containing(trees, target_nt):
+        for _, _, node in tree.index().outermost(target_nt):
+            if n == 0:
+                ret_strs.append(node.derived_string())
+            else:
+                # A terminal child is found wherever its payload occurs, and derives just that
+                child_strs = [[c.derived_string()] if c.is_terminal else child_derivable(trees, c.payload, n-1, max_samples)
+                              for c in node.children]
+                ret_strs.extend(sample_from_product_ext(child_strs, max_samples))
+    ret_strs = list(dict.fromkeys(ret_strs))
     if len(ret_strs) > max_samples:
         return random.sample(ret_strs, max_samples)
         # return list(dict.fromkeys(ret_strs))[:max_samples]
     return ret_strs
 
+
+def derivable_shape(trees, nt: str, n: int):
+    """
+    What `lvl_n_derivable` reads of `trees` for `nt` at level `n`: the distinct strings
+    of the outermost nodes labeled `nt` at level 0, and the children of each of them
+    at other levels, in order.
+    """
+    nodes = [node for tree in trees_containing(trees, nt) for _, _, node in tree.index().outermost(nt)]
+    if n == 0:
+        return list(dict.fromkeys(node.derived_string() for node in nodes))
+    return tuple(tuple(c.derived_string() if c.is_terminal else (c.payload,) for c in node.children) for node in nodes)
+
+
+class DerivableEntry:
+
+    def __init__(self, serial: int, stamp: Tuple[int, ...], shape, children: Dict[str, int], strings: List[str]):
+        self.serial = serial
+        # versions of the tree indices the entry was last checked against
+        self.stamp = stamp
+        self.shape = shape
+        # nonterminal child -> serial of its entry one level down
+        self.children = children
+        self.strings = strings
+
+
+class DerivableCache:
+    """
+    Memo of `lvl_n_derivable`, by nonterminal, level and number of samples. Only the
+    results that drew no random samples (computing them left the state of `random`
+    as it was) are kept, so a hit returns just what recomputing it would, and leaves
+    the state of `random` as it would.
+
+    The trees change between calls, as bubbles are applied and nonterminals merged.
+    When they have, an entry is checked before it is used: it stays if what it read
+    of the trees (`derivable_shape`) is the same as when it was made, and the entries
+    one level down of its nonterminal children stay and are the ones it was made
+    from. So only the entries of nonterminals whose subtrees changed are recomputed.
+
+    >>> tree_1 = ParseNode('t0', False, [ParseNode('t3', False, [ParseNode('3', True, [])])])
+    >>> tree_2 = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('(', True, [])]), tree_1.copy(), ParseNode('t2', False, [ParseNode(')', True, [])])])
+    >>> cache = DerivableCache()
+    >>> cache.lookup([tree_1, tree_2], 't0', 1, 10), cache.lookup([tree_1, tree_2], 't0', 1, 10)
+    (['3', '(3)', '((3))'], ['3', '(3)', '((3))'])
+    >>> tree_2.children[1].children[0].children[0].payload = '4'
+    >>> tree_2.update_cache_info()
+    >>> cache.lookup([tree_1, tree_2], 't0', 1, 10)
+    ['3', '4', '(3)', '((4))']
+    >>> cache.hits, cache.misses  # t1 and t2 were still valid
+    (3, 8)
+    """
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, int, int], DerivableEntry] = {}
+        self.serials = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def lookup(self, trees, target_nt, n, max_samples) -> List[str]:
+        stamp = tuple(tree.index().version for tree in trees)
+        key = (target_nt, n, max_samples)
+        if self._valid(trees, stamp, key):
+            self.hits += 1
+            return list(self.entries[key].strings)
+        self.misses += 1
+        # The result was sampled if computing it (or any of its children) drew from `random`
+        state = random.getstate()
+        strings = compute_lvl_n_derivable(trees, target_nt, n, max_samples, self.lookup)
+        if random.getstate() == state:
+            shape = derivable_shape(trees, target_nt, n)
+            # Not sampled, so every child's result was not sampled either and has an entry
+            children = {} if n == 0 else \
+                {child[0]: self.entries[(child[0], n - 1, max_samples)].serial
+                 for children in shape for child in children if isinstance(child, tuple)}
+            self.entries[key] = DerivableEntry(next(self.serials), stamp, shape, children, strings)
+        return list(strings)
+
+    def _valid(self, trees, stamp: Tuple[int, ...], key: Tuple[str, int, int]) -> bool:
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if entry.stamp == stamp:
+            return True
+        nt, n, max_samples = key
+        if derivable_shape(trees, nt, n) != entry.shape or \
+                any(not self._valid(trees, stamp, (child, n - 1, max_samples))
+                    or self.entries[(child, n - 1, max_samples)].serial != serial
+                    for child, serial in entry.children.items()):
+            del self.entries[key]
+            return False
+        entry.stamp = stamp
+        return True
+
+
+DERIVABLE_CACHE = DerivableCache()
+
 def sample_from_product_ext(strings_per_child, num_samples):
     lens_per_child = [len(spc) for spc in strings_per_child]
     prod_size = muh_product(lens_per_child)
@@ -304,6 +438,76 @@ def get_all_rule_replacement_strs(tree: ParseNode, replacee_rule: Tuple[str, Lis
 
     return list(set(ret_list))
 
+def nonterminal_occurrences(trees) -> Dict[str, FrozenSet[Tuple[str, Tuple[Tuple[int, int], ...]]]]:
+    """
+    Maps each nonterminal in `trees` to where it occurs: a set of (example string,
+    spans of the occurrences in it) for the trees it occurs in. Together with the
+    replacement strings, this is all `get_strings_with_replacement` draws its
+    candidates from, whatever the nonterminal is called.
+    >>> tree_1 = ParseNode('t0', False, [ParseNode('t3', False, [ParseNode('3', True, [])])])
+    >>> tree_2 = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('(', True, [])]), tree_1, ParseNode('t2', False, [ParseNode(')', True, [])])])
+    >>> occurrences = nonterminal_occurrences([tree_1, tree_2])
+    >>> sorted(occurrences['t3'])
+    [('(3)', ((1, 2),)), ('3', ((0, 1),))]
+    >>> sorted(occurrences['t0'])
+    [('(3)', ((0, 3), (1, 2))), ('3', ((0, 1),))]
+    >>> nonterminal_occurrences(ParseTreeList([tree_1, tree_2])) == occurrences
+    True
+    """
+    if isinstance(trees, ParseTreeList):
+        occurrences = {}
+        for nt in trees.nonterminals():
+            entries = set()
+            for tree in trees.trees_with(nt):
+                spans = tuple(span for _, span, _ in tree.index().nodes(nt))
+                if spans:
+                    entries.add((tree.derived_string(), spans))
+            if entries:
+                occurrences[nt] = frozenset(entries)
+        return occurrences
+    occurrences = {}
+    for tree in trees:
+        example = tree.derived_string()
+        spans = {}
+
+        def visit(node: ParseNode, start: int) -> int:
+            if node.is_terminal:
+                return start + len(fixup_terminal(node.payload))
+            spans.setdefault(node.payload, [])
+            posn = len(spans[node.payload])
+            spans[node.payload].append(None)
+            end = start
+            for child in node.children:
+                end = visit(child, end)
+            spans[node.payload][posn] = (start, end)
+            return end
+
+        visit(tree, 0)
+        for nt, nt_spans in spans.items():
+            occurrences.setdefault(nt, set()).add((example, tuple(nt_spans)))
+    return {nt: frozenset(entries) for nt, entries in occurrences.items()}
+
+
+def merge_fingerprint(replacement_strs: List[str], occurrences: FrozenSet[Tuple[str, Tuple[Tuple[int, int], ...]]]) -> bytes:
+    """
+    Canonical key for replacing the `occurrences` of a nonterminal (as given by
+    `nonterminal_occurrences`) by `replacement_strs`, independent of the order of
+    the strings and trees and of the names of the nonterminals.
+    >>> occs = frozenset([('(3)', ((1, 2),)), ('3', ((0, 1),))])
+    >>> merge_fingerprint(['1', '2'], occs) == merge_fingerprint(['2', '1', '2'], frozenset(reversed(list(occs))))
+    True
+    >>> merge_fingerprint(['1', '2'], occs) == merge_fingerprint(['1'], occs)
+    False
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for replacement_str in sorted(set(replacement_strs)):
+        h.update(repr(replacement_str).encode('utf-8'))
+    h.update(b'\0')
+    for occurrence in sorted(occurrences):
+        h.update(repr(occurrence).encode('utf-8'))
+    return h.digest()
+
+
 def get_strings_with_replacement(tree: ParseNode, nt_to_replace: str, replacement_strs: List[str]):
     """
     Get all the possible strings derived from `tree` where all possible combinations
@@ -9,6 +9,12 @@ import sys
 import antlr_utils
 
 import random
+import os
+
+# Content-addressed cache of built ANTLR parsers (see antlr_build_key), shared by
+# all benchmarks, so that recreating a benchmark doesn't recompile its parser.
+ANTLR_BUILD_CACHE = os.environ.get("TREEVADA_BUILD_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "treevada", "antlr-builds"))
 
 INFINITY = 1_000_000
 
@@ -559,7 +565,7 @@ def sample_grammar(grammar_contents: str):
         print("=====")
         print(sample)
 
-def main(folder_root, grammar_contents_name, antlr_mode : bool):
+def main(folder_root, grammar_contents_name, antlr_mode : bool, two_stage : bool = False):
     """
     Does all the benchmark-creation work:
     - `folder_root` is where to put the benchmark
@@ -567,6 +573,8 @@ def main(folder_root, grammar_contents_name, antlr_mode : bool):
       check for a _no_lr version (one w/o LR recursion) if it exists)
     - `antlr_mode`: if True, create an efficient c++ ANTLR parser. otherwise
        just a python parser.
+    - `two_stage`: make the ANTLR parser try SLL prediction before full LL (see
+       antlr_utils.parser_contents), and report how often the test set needs LL.
     """
 
     import os
@@ -583,8 +591,10 @@ def main(folder_root, grammar_contents_name, antlr_mode : bool):
 
     results_folder = os.path.join(folder_root, plain_name)
 
+    # An existing benchmark is updated in place: its examples are regenerated, and
+    # its parser rebuilt only if the build inputs changed (see antlr_build_key)
     try:
-        os.mkdir(results_folder)
+        os.makedirs(results_folder, exist_ok=True)
     except OSError as e:
         print(e)
         print(f"[!!!] Couldn't create {results_folder}. Underlying error above.")
@@ -613,6 +623,16 @@ from lark import Lark
 
 target_grammar = \"\"\"{grammar_contents}\"\"\"
 
+_parser = None
+
+def accepts(input_contents):
+    # In-process entry point, so this file can be used as a `parse_<name>:accepts` oracle
+    global _parser
+    if _parser is None:
+        _parser = Lark(target_grammar)
+    _parser.parse(input_contents.rstrip())
+    return True
+
 def main():
     if len(sys.argv) != 2:
         print("Usage: {sys.argv[0]} <input-file>")
@@ -630,39 +650,41 @@ if __name__ == '__main__':
 
     cpp_dir = os.path.join(results_folder, "cpp-build")
 
+    wd = None
     try:
         if antlr_mode:
             gram_name = "g_" + plain_name
-            os.mkdir(cpp_dir)
+            os.makedirs(cpp_dir, exist_ok=True)
             if nolr_grammar_lines:
                 antlr_contents = antlr_utils.lark_to_antlr(gram_name, nolr_grammar_lines)
             else:
                 antlr_contents = antlr_utils.lark_to_antlr(gram_name, grammar_contents_lines)
-            antlr_file_name = os.path.join(cpp_dir, f"{gram_name}.g4")
-            antlr_file = open(antlr_file_name, "w")
-            antlr_file.write(antlr_contents)
-            antlr_file.close()
-
-            cmake_file_name = os.path.join(cpp_dir, f"CMakeLists.txt")
-            cmake_file = open(cmake_file_name, "w")
-            cmake_file.write(antlr_utils.cmake_contents(gram_name))
-            cmake_file.close()
-
-            parser_file_name = os.path.join(cpp_dir, f"file_parser.cpp")
-            parser_file = open(parser_file_name, "w")
-            parser_file.write(antlr_utils.parser_contents(gram_name, "file"))
-            parser_file.close()
-
-            # make and copy out of the cpp dir
-            import subprocess
-            wd = os.getcwd()
-            os.chdir(cpp_dir)
-            subprocess.run(["cmake", "."], check=True)
-            subprocess.run(["make"], check=True)
+            sources = {f"{gram_name}.g4": antlr_contents,
+                       "CMakeLists.txt": antlr_utils.cmake_contents(gram_name),
+                       "file_parser.cpp": antlr_utils.parser_contents(gram_name, "file", two_stage),
+                       "server_parser.cpp": antlr_utils.parser_contents(gram_name, "server", two_stage)}
+            for source_name, contents in sources.items():
+                source_file = open(os.path.join(cpp_dir, source_name), "w")
+                source_file.write(contents)
+                source_file.close()
 
-            os.chdir(wd)
             import shutil
-            shutil.copy(os.path.join(cpp_dir, "file_parser"), os.path.join(results_folder, f"parse_{plain_name}"))
+            cached_build = os.path.join(ANTLR_BUILD_CACHE, antlr_build_key(sources))
+            if os.path.isdir(cached_build):
+                print(f"Reusing the parser built in {cached_build}")
+            else:
+                # make and copy out of the cpp dir
+                import subprocess
+                wd = os.getcwd()
+                os.chdir(cpp_dir)
+                subprocess.run(["cmake", "."], check=True)
+                subprocess.run(["make"], check=True)
+                os.chdir(wd)
+                store_antlr_build(cpp_dir, cached_build)
+
+            shutil.copy(os.path.join(cached_build, "file_parser"), os.path.join(results_folder, f"parse_{plain_name}"))
+            # Long-lived worker for search.py/eval.py --worker-cmd
+            shutil.copy(os.path.join(cached_build, "server_parser"), os.path.join(results_folder, f"serve_{plain_name}"))
         else:
             parse_program_file = open(os.path.join(results_folder, f"parse_{plain_name}"), "w")
             parse_program_file.write(parse_program_contents)
@@ -677,7 +699,7 @@ if __name__ == '__main__':
 
     guide_examples_folder = os.path.join(results_folder, "guides")
     try:
-        os.mkdir(guide_examples_folder)
+        make_examples_folder(guide_examples_folder)
     except OSError as e:
         print(e)
         print(f"[!!!] Couldn't create {guide_examples_folder}. Underlying error above.")
@@ -699,7 +721,7 @@ if __name__ == '__main__':
 
     random_guide_examples_folder = os.path.join(results_folder, "random-guides")
     try:
-        os.mkdir(random_guide_examples_folder)
+        make_examples_folder(random_guide_examples_folder)
     except OSError as e:
         print(e)
         print(f"[!!!] Couldn't create {random_guide_examples_folder}. Underlying error above.")
@@ -721,7 +743,7 @@ if __name__ == '__main__':
 
     test_set_folder = os.path.join(results_folder, "test_set")
     try:
-        os.mkdir(test_set_folder)
+        make_examples_folder(test_set_folder)
     except OSError as e:
         print(e)
         print(f"[!!!] Couldn't create {test_set_folder}. Underlying error above.")
@@ -741,21 +763,122 @@ if __name__ == '__main__':
             print(f"[!!!] Couldn't write guide example to {sample_name}. Underlying error above.")
             exit(1)
 
+    if antlr_mode and two_stage:
+        report_ll_fallbacks(os.path.join(results_folder, f"parse_{plain_name}"), test_set_folder)
+
+
+def antlr_build_key(sources: Dict[str, str]) -> str:
+    """
+    Content hash of everything that goes into building an ANTLR parser: the
+    sources in `sources` (file name -> contents, including the .g4 grammar and
+    the CMakeLists.txt), the ANTLR tool that generates the parser sources from
+    the grammar (see antlr_tool_identity) and the ANTLR runtime they are built
+    against.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    for name in sorted(sources):
+        h.update(bytes(f"{name}\0{sources[name]}\0", 'utf-8'))
+    h.update(bytes(f"{antlr_tool_identity()}\0", 'utf-8'))
+    runtime = os.environ["ANTLR_RUNTIME"]
+    h.update(bytes(f"{os.path.abspath(runtime)}\0", 'utf-8'))
+    runtime_lib = os.path.join(runtime, "dist", "libantlr4-runtime.a")
+    if os.path.exists(runtime_lib):
+        # Rebuilding the runtime in place should invalidate the parsers built on it
+        stat = os.stat(runtime_lib)
+        h.update(bytes(f"{stat.st_size}:{stat.st_mtime_ns}", 'utf-8'))
+    return h.hexdigest()
+
+
+def antlr_tool_identity() -> str:
+    """
+    Identifies the ANTLR tool the CMakeLists.txt runs as `antlr4`: the version it
+    reports, and the digest of the ANTLR jars on the CLASSPATH, so that upgrading
+    the tool invalidates the parsers it generated.
+    """
+    import glob
+    import hashlib
+    import subprocess
+    try:
+        # Run without arguments, the tool prints its version and usage
+        result = subprocess.run(["antlr4"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+        version = result.stdout.decode('utf-8', 'replace').strip().splitlines()[:1]
+    except (OSError, subprocess.SubprocessError):
+        version = []
+    h = hashlib.sha256()
+    for entry in os.environ.get("CLASSPATH", "").split(os.pathsep):
+        for jar in sorted(glob.glob(entry)):
+            if "antlr" in os.path.basename(jar).lower() and os.path.isfile(jar):
+                with open(jar, 'rb') as f:
+                    h.update(f.read())
+    return f"{''.join(version)}\0{h.hexdigest()}"
+
+
+def store_antlr_build(cpp_dir: str, cached_build: str):
+    """
+    Copies the binaries built in `cpp_dir` to the build cache entry `cached_build`.
+    The entry is filled in under a temporary name and then renamed, so that
+    concurrent builds never see a partial entry.
+    """
+    import shutil
+    import tempfile
+    os.makedirs(ANTLR_BUILD_CACHE, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=ANTLR_BUILD_CACHE)
+    for binary in ["file_parser", "server_parser"]:
+        shutil.copy(os.path.join(cpp_dir, binary), os.path.join(staging, binary))
+    try:
+        os.rename(staging, cached_build)
+    except OSError:
+        # Someone else stored the same build first
+        shutil.rmtree(staging)
+
+
+def make_examples_folder(folder: str):
+    """
+    Creates `folder`, or empties it of the examples of a previous run.
+    """
+    os.makedirs(folder, exist_ok=True)
+    for file_name in os.listdir(folder):
+        if file_name.endswith(".ex"):
+            os.remove(os.path.join(folder, file_name))
+
+
+def report_ll_fallbacks(parser_command: str, examples_folder: str, batch_size=200):
+    """
+    Runs the two-stage parser `parser_command` on the examples in `examples_folder`
+    (in batches, see oracle.py) and prints how many needed the full LL fallback.
+    """
+    import subprocess
+    file_names = [os.path.join(examples_folder, f) for f in sorted(os.listdir(examples_folder))]
+    fallbacks = 0
+    for i in range(0, len(file_names), batch_size):
+        batch = file_names[i:i + batch_size]
+        result = subprocess.run([parser_command] + batch, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        fallbacks += result.stderr.count(antlr_utils.LL_FALLBACK_MARKER)
+    if file_names:
+        print(f"LL fallback needed for {fallbacks} of {len(file_names)} examples "
+              f"({100 * fallbacks / len(file_names):.1f}%)")
+
 
 
 if __name__ == "__main__":
     """
     Two usage modes:
     """
+    two_stage = "--two-stage" in sys.argv
+    if two_stage:
+        sys.argv.remove("--two-stage")
     if len(sys.argv) == 3:
         """
         Creates a benchmark in BENCHMARK_FOLDER_ROOT/GRAMMAR_FILE, which
-        includes an ANTLR C++ parser, guide examples, and a test set. 
-          $ python sample_lark.py BENCHMARK_FOLDER_ROOT GRAMMAR_FILE.LARK
+        includes an ANTLR C++ parser, guide examples, and a test set. With
+        --two-stage, the parser tries SLL prediction before full LL.
+          $ python sample_lark.py [--two-stage] BENCHMARK_FOLDER_ROOT GRAMMAR_FILE.LARK
         """
         folder_root = sys.argv[1]
         grammar_contents_name = sys.argv[2]
-        main(folder_root, grammar_contents_name, True)
+        main(folder_root, grammar_contents_name, True, two_stage)
     else:
         """
         Just print out guide examples to stdout:
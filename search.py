@@ -3,9 +3,10 @@ import random, sys, os, time
 from input import parse_input
 from parse_tree import ParseTree, ParseNode
 from grammar import Grammar, Rule
-from start import build_start_grammar, get_times
+import start
+from start import build_start_grammar, get_times, get_prefilter_stats
 from lark import Lark
-from oracle import CachingOracle, ExternalOracle
+from oracle import CachingOracle, ExternalOracle, ParseException, make_oracle, INPUT_MODES, TIMEOUT_LATENCY_FACTOR
 import string
 
 """
@@ -16,6 +17,11 @@ See __main__ dispatch at the bottom for usage.
 
 USE_PRETOKENIZATION = True
 
+# Deadline in seconds for an oracle query. None derives it from the latencies
+# of the seed validations (times ORACLE_TIMEOUT_FACTOR); 0 means no deadline.
+ORACLE_TIMEOUT = None
+ORACLE_TIMEOUT_FACTOR = TIMEOUT_LATENCY_FACTOR
+
 GROUP_PUNCTUATION = False
 SPLIT_UPPER_AND_LOWER = True
 quote = []
@@ -84,12 +90,19 @@ def main_internal(external_folder, log_file, random_guides=False):
     else:
         guide_folder = os.path.join(external_folder, "guides-debug")
     parser_command = os.path.join(external_folder, f"parse_{bench_name}")
+    # ANTLR benchmarks also come with a long-lived worker
+    worker_command = os.path.join(external_folder, f"serve_{bench_name}")
+    if not os.path.exists(worker_command):
+        worker_command = None
 
-    main(parser_command, guide_folder, log_file)
+    main(parser_command, guide_folder, log_file, worker_command)
 
 
-def main(oracle_cmd, guide_examples_folder,  log_file_name):
-    oracle = ExternalOracle(oracle_cmd)
+def main(oracle_cmd, guide_examples_folder,  log_file_name, worker_cmd=None, jobs=1, oracle_processes=0, cache_file=None, cache_mb=None,
+         record_file=None, replay_file=None, input_mode='file', batch_size=0, zygote=False):
+    cache_budget = cache_mb * 2**20 if cache_mb is not None else None
+    oracle = make_oracle(oracle_cmd, worker_cmd, jobs, oracle_processes, cache_file, cache_budget,
+                         ORACLE_TIMEOUT or None, record_file, replay_file, input_mode, batch_size, zygote)
     if USE_PRETOKENIZATION:
        print("Using approximate pre-tokenization stage")
 
@@ -106,7 +119,7 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
             
             oracle.parse(guide_raw)
 
-        except:
+        except ParseException:
             print("\n xxxInvalid seed input")
             print(full_filename)
             exit(1)
@@ -115,6 +128,9 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
         else:
             guide = [ParseNode(c, True, []) for c in guide_raw]
         guide_examples.append(guide)
+    if ORACLE_TIMEOUT is None:
+        oracle.adapt_timeout(ORACLE_TIMEOUT_FACTOR)
+    print(f"Oracle timeout: {oracle.timeout}")
     has_bracket = sum([1 for g in raw_examples if "(" in g or ")" in g
                        or "[" in g or "]" in g 
                        or "{" in g or "}" in g])
@@ -159,6 +175,19 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
         print(f'Time breakdown: {get_times()}')
         print(f'Parse calls: {oracle_parse_calls}, {oracle_real_calls}')
         print(f'Parse calls: {oracle_parse_calls}, {oracle_real_calls}', file=f)
+        print(f'Oracle cache: {oracle.cache_set.stats()}')
+        print(f'Oracle cache: {oracle.cache_set.stats()}', file=f)
+        if start.PAIR_PREFILTER is not None:
+            print(f'Pair prefilter ({start.PAIR_PREFILTER}): {get_prefilter_stats()}')
+            print(f'Pair prefilter ({start.PAIR_PREFILTER}): {get_prefilter_stats()}', file=f)
+        if oracle.disk_cache is not None:
+            print(f'Disk cache: {oracle.disk_cache.stats()}')
+            print(f'Disk cache: {oracle.disk_cache.stats()}', file=f)
+        print(f'Oracle timeouts (assumed valid): {len(oracle.timeouts)} with deadline {oracle.timeout}s')
+        print(f'Oracle timeouts (assumed valid): {len(oracle.timeouts)} with deadline {oracle.timeout}s', file=f)
+        for timed_out in oracle.timeouts:
+            print(f'    {repr(timed_out)}', file=f)
+    oracle.close()
 
 
 if __name__ == '__main__':
@@ -170,13 +199,29 @@ if __name__ == '__main__':
     internal_parser.add_argument('bench_folder', help='folder containing the benchmark', type=str)
     internal_parser.add_argument('log_file', help='name of file to write output log to', type=str)
 
-    external_parser.add_argument('oracle_cmd', help='the oracle command; should be invocable on a filename via `oracle_cmd filename`, and return a non-zero exit code on invalid inputs', type=str)
+    external_parser.add_argument('oracle_cmd', help='the oracle command; should be invocable on a filename via `oracle_cmd filename`, and return a non-zero exit code on invalid inputs. A `module:function` spec calls a Python function in-process instead', type=str)
     external_parser.add_argument('examples_dir', help='folder containing the training examples', type=str)
     external_parser.add_argument('log_file', help='name of file to write output log to', type=str)
     external_parser.add_argument('--no-pretokenize',  help=f'assign each character to its own leaf node, rather than grouping characters of same lassc', action='store_true', dest='no_pretokenize')
     external_parser.add_argument('--group_punctuation', help=f'group sequences of punctuation during pretokenization', action='store_true')
     external_parser.add_argument('--group_upper_lower',
                                  help=f'group uppercase characters with lowerchase characters during pretokenization', action='store_true')
+    external_parser.add_argument('--worker-cmd', help='a long-lived oracle worker speaking the length-prefixed protocol described in oracle.py; oracle_cmd is used as a fallback', type=str, default=None, dest='worker_cmd')
+    external_parser.add_argument('-j', '--jobs', help='number of oracle queries to run concurrently (default 1)', type=int, default=1)
+    external_parser.add_argument('--oracle-processes', help='with a `module:function` oracle, call it in a pool of this many processes instead of in-process', type=int, default=0, dest='oracle_processes')
+    external_parser.add_argument('--cache-db', help='sqlite file to keep the oracle answers in across runs; created if it does not exist', type=str, default=None, dest='cache_file')
+    external_parser.add_argument('--cache-mb', help='memory budget in MB of the in-memory oracle cache (default unbounded); least useful answers are evicted beyond it', type=float, default=None, dest='cache_mb')
+    external_parser.add_argument('--record', help='record the oracle answers of this run to a trace file', type=str, default=None, dest='record_file')
+    external_parser.add_argument('--replay', help='answer oracle queries from a trace recorded with --record instead of running oracle_cmd, failing on queries missing from it', type=str, default=None, dest='replay_file')
+    external_parser.add_argument('--input-mode', help='how inputs are handed to oracle_cmd: a temporary file per query (default), piped on stdin as /dev/stdin, an in-memory memfd, or a reused tmpfs file', choices=INPUT_MODES, default='file', dest='input_mode')
+    external_parser.add_argument('--batch-size', help='check up to this many inputs per run of oracle_cmd, as `oracle_cmd f1 ... fN`; see "Batch mode" in oracle.py for the output it must produce', type=int, default=0, dest='batch_size')
+    external_parser.add_argument('--zygote', help='oracle_cmd is a Python script: run it from a pre-forked zygote server (zygote.py) that keeps its imports loaded, instead of starting Python for each query', action='store_true')
+    external_parser.add_argument('--timeout', help='deadline in seconds for an oracle query, after which the input is assumed valid; 0 for none (default: derived from the seed validation times)', type=float, default=None)
+    external_parser.add_argument('--timeout-factor', help=f'with no --timeout, the deadline is this times the 99th percentile seed validation time (default {TIMEOUT_LATENCY_FACTOR})', type=float, default=TIMEOUT_LATENCY_FACTOR, dest='timeout_factor')
+    external_parser.add_argument('--speculative', help='validate all candidate strings of a merge at once, killing the outstanding oracle queries on the first rejection; only with the one-shot oracle_cmd, as --worker-cmd, --zygote and --batch-size queries can\'t be killed, so those keep to --jobs', action='store_true')
+    external_parser.add_argument('--pair-prefilter', help='rank the nonterminal pairs of a coalesce by cheap signatures before checking them; conservative only reorders them, aggressive also skips pairs unlikely to merge', choices=('conservative', 'aggressive'), default=None, dest='pair_prefilter')
+    external_parser.add_argument('--memoize-rejections', help='remember the merges the oracle rejected and reject them again without generating candidate strings when they recur in unchanged trees', action='store_true', dest='memoize_rejections')
+    external_parser.add_argument('--coalesce-window', help='in the initial coalesces over all nonterminal pairs, check this many pairs concurrently; merges are the same as checking them one at a time', type=int, default=0, dest='coalesce_window')
     #TODO: what is this error?
     args = parser.parse_args()
     if args.mode == 'internal':
@@ -188,7 +233,15 @@ if __name__ == '__main__':
             GROUP_PUNCTUATION = True
         if args.group_upper_lower:
             SPLIT_UPPER_AND_LOWER = False
-        main(args.oracle_cmd, args.examples_dir, args.log_file)
+        ORACLE_TIMEOUT = args.timeout
+        ORACLE_TIMEOUT_FACTOR = args.timeout_factor
+        if args.speculative:
+            start.SPECULATIVE_VALIDATION = True
+        start.PARALLEL_COALESCE_WINDOW = args.coalesce_window
+        start.PAIR_PREFILTER = args.pair_prefilter
+        start.MEMOIZE_REJECTED_MERGES = args.memoize_rejections
+        main(args.oracle_cmd, args.examples_dir, args.log_file, args.worker_cmd, args.jobs, args.oracle_processes, args.cache_file, args.cache_mb,
+             args.record_file, args.replay_file, args.input_mode, args.batch_size, args.zygote)
     else:
         parser.print_help()
         exit(1)
@@ -1,18 +1,22 @@
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Set, Dict, Optional, Union
 import statistics
 from bubble import Bubble
-from group import group, is_balanced
+from group import group, is_balanced, BubbleTable
 from oracle import ExternalOracle, ParseException
 from parse_tree import ParseNode, ParseTreeList, build_grammar, START
 from grammar import *
 from token_expansion import expand_tokens
 from union import UnionFind
 from replacement_utils import get_strings_with_replacement, get_strings_with_replacement_in_rule, \
-    lvl_n_derivable
+    lvl_n_derivable, nonterminal_occurrences, merge_fingerprint, trees_containing, trees_containing_rule, \
+    DERIVABLE_CACHE
 
 from next_tid import allocate_tid
+from pair_prefilter import PairPrefilter
+from relabel import TreeRelabeler
 
 """
 Bulk of the Arvada algorithm.
@@ -39,6 +43,25 @@ MAX_GROUP_LEN = 10
 GROUP_INCREMENT = False
 MUST_EXPAND_IN_COALESCE = False
 MUST_EXPAND_IN_PARTIAL= False
+# Send all the candidate strings of a merge to the oracle at once, killing
+# the outstanding queries as soon as one of them is rejected
+SPECULATIVE_VALIDATION = False
+# Number of nonterminal pairs checked concurrently in a full coalesce (one
+# without a target); 0 or 1 checks them one at a time
+PARALLEL_COALESCE_WINDOW = 0
+# Rank the nonterminal pairs of a full coalesce (one without a target) by cheap
+# signatures (pair_prefilter.py) before checking them. 'conservative' only reorders them, counting what pruning
+# unlikely pairs would save and lose; 'aggressive' also skips those pairs.
+PAIR_PREFILTER = None
+# Remember the merges the oracle rejected, by a fingerprint of the replacement
+# strings and of where the replaced nonterminal occurs in the trees, and reject
+# the same merge without generating candidates when it comes up again
+MEMOIZE_REJECTED_MERGES = False
+MAX_REJECTED_MERGES = 1 << 20
+# Keep the bubble windows of each tree layer from one regrouping in build_trees to
+# the next, computing them only for layers whose children or contexts changed. The
+# bubbles are still collected from all the layers and scored anew each time.
+REUSE_LAYER_WINDOWS = True
 
 ORIGINAL_COALESCE_TIME = 0
 BUILD_TIME = 0
@@ -49,13 +72,33 @@ MINIMIZE_TIME = 0
 TIME_GENERATING_EXAMPLES = 0
 TIME_GROUPING = 0
 REAPPLY = 0
+COALESCE_PAIRS_REDONE = 0
+REJECTED_MERGES_SKIPPED = 0
+# fingerprint -> None, oldest first; see MEMOIZE_REJECTED_MERGES
+REJECTED_MERGES = {}
+
+PREFILTER_PAIRS_PRUNED = 0
+PREFILTER_CALLS_SAVED = 0
+PREFILTER_MERGES_CHANGED = 0
 
 def get_times():
     from replacement_utils import TIME_GENERATING_EXAMPLES_INTERNAL
     return {'FIRST_COALESCE' : ORIGINAL_COALESCE_TIME, 'BUILD': BUILD_TIME,
             'LAST_COALESCE' : LAST_COALESCE_TIME, 'EXPAND': EXPAND_TIME, 'MINIMIZE': MINIMIZE_TIME,
             'OVERALL_EXAMPLE_GEN': TIME_GENERATING_EXAMPLES + TIME_GENERATING_EXAMPLES_INTERNAL,
-            'OVERALL_GROUPING': TIME_GROUPING, 'REAPPLY_COUNT': REAPPLY}
+            'OVERALL_GROUPING': TIME_GROUPING, 'REAPPLY_COUNT': REAPPLY,
+            'COALESCE_PAIRS_REDONE': COALESCE_PAIRS_REDONE, 'REJECTED_MERGES_SKIPPED': REJECTED_MERGES_SKIPPED,
+            'DERIVABLE_CACHE_HIT_RATE': DERIVABLE_CACHE.hit_rate()}
+
+def get_prefilter_stats():
+    """
+    Counts of the pair prefilter: the pairs it deems unlikely to merge, and, in
+    the conservative mode, the oracle calls checking them took and how many of
+    them did merge, i.e. what the aggressive mode would save and lose. Calls are
+    not counted for pairs checked by a parallel coalesce window.
+    """
+    return {'PAIRS_PRUNED': PREFILTER_PAIRS_PRUNED, 'ORACLE_CALLS_SAVED': PREFILTER_CALLS_SAVED,
+            'MERGES_CHANGED': PREFILTER_MERGES_CHANGED}
 
 def check_recall(oracle, grammar: Grammar):
     """
@@ -65,13 +108,13 @@ def check_recall(oracle, grammar: Grammar):
     for pos in positives:
         try:
             oracle.parse(pos)
-        except:
+        except ParseException:
             return False
     return True
 
 def build_start_grammar(oracle, leaves, bbl_bounds = (3,10)):
     """
-    ORACLE is a CachingOracle or ExternalOracle with a .parse method, which
+    ORACLE is an oracle.Oracle (e.g. an ExternalOracle) with a .parse method, which
     returns True if the example given is in the ORACLE's language
 
     LEAVES is a list of positive examples, each  a list of characters.
@@ -84,6 +127,9 @@ def build_start_grammar(oracle, leaves, bbl_bounds = (3,10)):
     global MIN_GROUP_LEN 
     global MAX_GROUP_LEN
     MIN_GROUP_LEN, MAX_GROUP_LEN = bbl_bounds
+    # Rejections are only known for the oracle they came from
+    REJECTED_MERGES.clear()
+    DERIVABLE_CACHE.clear()
     print('Building the starting trees...'.ljust(50), end='\r')
     trees, classes = build_trees(oracle, leaves)
     print('Building initial grammar...'.ljust(50), end='\r')
@@ -178,7 +224,7 @@ def build_naive_parse_trees(leaves: List[List[ParseNode]], bracket_items: List,
             
             oracle.parse(new_children.derived_string())
 
-        except:
+        except ParseException:
             print("\nInvalid seed input")
             exit(1)
 
@@ -360,13 +406,14 @@ def build_trees(oracle, leaves):
     # Main algorithm loop. Iteratively increase the length of groups allowed from MIN_GROUP_LEN to MAX_GROUP_LEN
     # break the group_size loop if no valid merge after increasing group size by threshold
     threshold = 5
+    bubble_table = BubbleTable() if REUSE_LAYER_WINDOWS else None
     for group_size in range(MIN_GROUP_LEN, MAX_GROUP_LEN):
 
         count = 1
         updated = True
         while updated:
             group_start = time.time()
-            all_groupings = group(best_trees, group_size, GROUP_INCREMENT)
+            all_groupings = group(best_trees, group_size, GROUP_INCREMENT, table=bubble_table)
             TIME_GROUPING += time.time() - group_start
             updated, nlg = False, len(all_groupings)
             for i, (grouping, the_score) in enumerate(all_groupings):
@@ -497,7 +544,7 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
 
         # Check whether `replaceable_everywhere` is replaceable by `replaceable_in_some_rules` everywhere.
         everywhere_by_some_candidates = []
-        for tree in trees:
+        for tree in trees_containing(trees, replaceable_everywhere):
             everywhere_by_some_candidates.extend(
                 get_strings_with_replacement(tree, replaceable_everywhere, in_some_derivable_strings))
 
@@ -511,10 +558,7 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
             language_expanded = False
         else:
             language_expanded = MUST_EXPAND_IN_PARTIAL
-            try:
-                for replaced_str in everywhere_by_some_candidates:
-                    oracle.parse(replaced_str)
-            except Exception as e:
+            if not all(oracle.parse_many(everywhere_by_some_candidates, speculative=SPECULATIVE_VALIDATION)):
                 return []
 
         if (len(everywhere_derivable_strings) == 0): return {}
@@ -525,7 +569,7 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
         for replacement_loc in partial_replacement_locs:
             rule, posn = replacement_loc
             candidate_strs = []
-            for tree in trees:
+            for tree in trees_containing_rule(trees, rule[0], rule[1]):
                 candidate_strs.extend(
                     get_strings_with_replacement_in_rule(tree, rule, posn, everywhere_derivable_strings))
             if len(candidate_strs) > MAX_SAMPLES_PER_COALESCE:
@@ -537,15 +581,9 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
                 replacing_positions[(rule[0], tuple(rule[1]))].append(posn)
                 continue
 
-            try:
-                candidate_index = 0
-                for candidate in candidate_strs:
-                    candidate_index += 1
-                    oracle.parse(candidate)
+            if all(oracle.parse_many(candidate_strs, speculative=SPECULATIVE_VALIDATION)):
                 replacing_positions[(rule[0], tuple(rule[1]))].append(posn)
                 language_expanded = True
-            except ParseException as e:
-                continue
 
         if MUST_EXPAND_IN_PARTIAL and coalesce_target is not None and not language_expanded:
             return []
@@ -699,7 +737,82 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
     RETURNS: the grammar after coalescing, the parse trees after coalescing,
     and whether any nonterminals were actually coalesced with each other
     (found equivalent).
+
+    With PARALLEL_COALESCE_WINDOW, the oracle is asked the same questions as without
+    it, and the random state ends up the same. Here t1 and t2 both derive a and b, so
+    replacing t3 by either is the same rejected merge:
+
+    >>> import start
+    >>> from oracle import CachingOracle
+    >>> def run(window):
+    ...     start.PARALLEL_COALESCE_WINDOW, start.MEMOIZE_REJECTED_MERGES = window, True
+    ...     start.REJECTED_MERGES.clear()
+    ...     start.REJECTED_MERGES_SKIPPED = 0
+    ...     node = lambda nt, c: ParseNode(nt, False, [ParseNode(c, True, [])])
+    ...     trees = [ParseNode('t0', False, [node('t1', 'a'), node('t2', 'b'), node('t3', 'c')]),
+    ...              ParseNode('t0', False, [node('t2', 'a'), node('t1', 'b'), node('t3', 'd')])]
+    ...     oracle = CachingOracle(Lark('start: "abc" | "abd"'))
+    ...     random.seed(0)
+    ...     coalesce(oracle, trees, build_grammar(trees))
+    ...     return start.REJECTED_MERGES_SKIPPED, oracle.parse_calls, random.random()
+    >>> run(0) == run(4)
+    True
+    >>> run(0)[0]
+    1
+    >>> start.PARALLEL_COALESCE_WINDOW, start.MEMOIZE_REJECTED_MERGES = 0, False
     """
+    global PREFILTER_CALLS_SAVED, PREFILTER_MERGES_CHANGED, PREFILTER_PAIRS_PRUNED
+
+    def sampled_replacements(replacer_derivable_strings, replacee, trees: ParseTreeList) -> List[str]:
+        """
+        Returns the strings `replacement_valid` checks: the positive examples with strings derivable
+        from `replacee` replaced by strings in `replacer_derivable_strings`, sampled down to
+        MAX_SAMPLES_PER_COALESCE of them, in random order.
+        """
+        # Get the set of positive examples with strings derivable from replacer
+        # replaced with strings derivable from replacee
+        replaced_strings = []
+        for tree in trees_containing(trees, replacee):
+            replaced_strings.extend(get_strings_with_replacement(tree, replacee, replacer_derivable_strings))
+
+        replaced_strings = list(dict.fromkeys(replaced_strings))
+        # replaced_strings = sorted(replaced_strings)
+        if len(replaced_strings) > MAX_SAMPLES_PER_COALESCE:
+            replaced_strings = random.sample(replaced_strings, MAX_SAMPLES_PER_COALESCE)
+            # replaced_strings = replaced_strings[:MAX_SAMPLES_PER_COALESCE]
+        else:
+            random.shuffle(replaced_strings)
+        return replaced_strings
+
+    occurrences = None
+
+    def rejection_key(replacer_derivable_strings, replacee, trees: ParseTreeList):
+        """
+        Fingerprint of replacing `replacee` in `trees` by `replacer_derivable_strings` for
+        REJECTED_MERGES, or None if rejections are not memoized. The fingerprint depends on
+        the contents of the trees, so a merge rejected in other trees is not assumed to be
+        rejected in these; the occurrence index is rebuilt whenever `trees` is replaced.
+        """
+        nonlocal occurrences
+        if not MEMOIZE_REJECTED_MERGES:
+            return None
+        if occurrences is None or occurrences[0] is not trees:
+            occurrences = (trees, nonterminal_occurrences(trees))
+        return merge_fingerprint(replacer_derivable_strings, occurrences[1].get(replacee, frozenset()))
+
+    def known_rejection(key) -> bool:
+        """
+        Whether the merge with fingerprint `key` was rejected before. Counted in
+        REJECTED_MERGES_SKIPPED by the caller once the check is committed to.
+        """
+        return key is not None and key in REJECTED_MERGES
+
+    def remember_rejection(key):
+        if key is None:
+            return
+        REJECTED_MERGES[key] = None
+        if len(REJECTED_MERGES) > MAX_REJECTED_MERGES:
+            REJECTED_MERGES.pop(next(iter(REJECTED_MERGES)))
 
     def replacement_valid(replacer_derivable_strings, replacee, trees : ParseTreeList) -> Tuple[bool, List[str]]:
         """
@@ -708,11 +821,12 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         **Replacing set() as it doesn't preserve the order. We want to get rid of all non-determinism.
         """
 
-        # Get the set of positive examples with strings derivable from replacer
-        # replaced with strings derivable from replacee
-        replaced_strings = []
-        for tree in trees:
-            replaced_strings.extend(get_strings_with_replacement(tree, replacee, replacer_derivable_strings))
+        global REJECTED_MERGES_SKIPPED
+        key = rejection_key(replacer_derivable_strings, replacee, trees)
+        if known_rejection(key):
+            REJECTED_MERGES_SKIPPED += 1
+            return False, []
+        replaced_strings = sampled_replacements(replacer_derivable_strings, replacee, trees)
 
         if len(replaced_strings) == 0:
             # TODO: See the failing doctest in bubble.py. Pickle below for a "real" example
@@ -722,20 +836,10 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
             return False, []
         #assert (replaced_strings)
 
-        replaced_strings = list(dict.fromkeys(replaced_strings))
-        # replaced_strings = sorted(replaced_strings)
-        if len(replaced_strings) > MAX_SAMPLES_PER_COALESCE:
-            replaced_strings = random.sample(replaced_strings, MAX_SAMPLES_PER_COALESCE)
-            # replaced_strings = replaced_strings[:MAX_SAMPLES_PER_COALESCE]
-        else:
-            random.shuffle(replaced_strings)
-
         # Return True if all the replaced_strings are valid
-        for s in replaced_strings:
-            try:
-                oracle.parse(s)
-            except:
-                return False, []
+        if not all(oracle.parse_many(replaced_strings, speculative=SPECULATIVE_VALIDATION)):
+            remember_rejection(key)
+            return False, []
         return True, replaced_strings
 
     def replacement_valid_and_expanding(nt1, nt2, trees: ParseTreeList):
@@ -778,46 +882,6 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         return True
 
 
-    def get_updated_trees(get_class: Dict[str, str], trees):
-
-        def replace_coalesced_nonterminals(node: ParseNode):
-            """
-                Rewrites node so that coalesced nonterminals point to their
-                class nonterminal. For non-coalesced nonterminals, get_class
-                just gives the original nonterminal
-                """
-            if node.is_terminal:
-                return
-            else:
-                node.payload = get_class.get(node.payload, node.payload)
-                for child in node.children:
-                    replace_coalesced_nonterminals(child)
-
-        def fix_double_indirection(node: ParseNode):
-            """
-                Fix parse trees that have an expansion of the for tx->tx (only one child)
-                since we've removed such double indirection while merging nonterminals
-                """
-            if node.is_terminal:
-                return
-
-            while len(node.children) == 1 and node.children[0].payload == node.payload:
-                # Won't go on forever because eventually length of children will be not 1,
-                # or the children's payload will not be the same as the top node (e.g. if
-                # the child is a terminal)
-                node.children = node.children[0].children
-
-            for child in node.children:
-                fix_double_indirection(child)
-
-        new_trees = []
-        for tree in trees:
-            new_tree = tree.copy()
-            replace_coalesced_nonterminals(new_tree)
-            fix_double_indirection(new_tree)
-            new_tree.update_cache_info()
-            new_trees.append(new_tree)
-        return new_trees
     # classes = {class_nt: [first, second]}
     # get_class = {first: class_nt, second: class_nt}
     def get_updated_grammar(classes: Dict[str, List[str]], get_class: Dict[str, str], grammar):
@@ -877,8 +941,20 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
     coalesced_into = {}
     checked = set()
     tree_list = ParseTreeList(trees, grammar)
+    # Copies the trees a merge touches the first time, so the caller's trees are left alone
+    relabeler = TreeRelabeler()
     merges = 0
-    for pair in pairs:
+    prefilter = None
+    # Signatures take a pass over the whole forest, which the few pairs of a targeted
+    # coalesce (one per grouping tried in build_trees) aren't worth
+    if PAIR_PREFILTER is not None and coalesce_target is None:
+        prefilter = PairPrefilter(tree_list)
+        pairs = prefilter.order(pairs)
+
+    def current_pair(pair):
+        """
+        Returns `pair` updated for the current grammar, or None if it need not be checked.
+        """
         first, second = pair
         # update the pair for the new grammar, because the pair was created before
         # we performed any merges. If one of the labels was merged, replace it with
@@ -889,27 +965,146 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
             second = coalesced_into[second]
         # and check that it's still valid
         if first == second:
-            continue
+            return None
         if (first, second) in checked:
-            continue
+            return None
+        return first, second
+
+    def pruned(first, second):
+        """
+        Whether the prefilter deems (first, second) unlikely to merge. Counted in
+        PREFILTER_PAIRS_PRUNED by the caller once the pair is committed to.
+        """
+        return prefilter is not None and not prefilter.compatible(first, second)
+
+    def merge(first, second):
+        nonlocal grammar, tree_list, coalesce_caused, merges
+        if first == START or second == START:
+            class_nt = START
         else:
+            class_nt = allocate_tid()
+        classes = {class_nt: [first, second]}
+        get_class = {first: class_nt, second: class_nt}
+        coalesced_into[first] = class_nt
+        coalesced_into[second] = class_nt
+        grammar = get_updated_grammar(classes, get_class, grammar)
+        new_inner_trees = relabeler.relabel(tree_list.inner_list, get_class)
+        tree_list = tree_list.merged(new_inner_trees, grammar, get_class)
+        coalesce_caused = True
+        merges += 1
+        if prefilter is not None:
+            prefilter.merge(first, second, class_nt)
+
+    def check_pairs_in_parallel(pairs):
+        """
+        Checks `pairs` in turn like the loop below, with the first oracle check of the next
+        PARALLEL_COALESCE_WINDOW pairs running concurrently. Each pair in the window is checked
+        against the current trees, assuming none of the pairs before it merge, and the verdicts
+        are committed in pair order. The random state after sampling each pair's strings is
+        kept, so the samples are the ones the sequential loop would draw. A merge, or a second
+        check that draws random numbers, makes the rest of the window stale: it is then
+        prepared and checked again from the pair after.
+
+        A pair with the same rejection fingerprint as one before it in the window is only
+        checked once that one is committed. If that one was rejected, the sequential loop
+        would skip the pair without sampling, so its check is dropped, the random state from
+        before its sampling restored, and the rest of the window made stale.
+        """
+        global TIME_GENERATING_EXAMPLES, COALESCE_PAIRS_REDONE, PREFILTER_MERGES_CHANGED, PREFILTER_PAIRS_PRUNED, \
+            REJECTED_MERGES_SKIPPED
+        executor = ThreadPoolExecutor(max_workers=PARALLEL_COALESCE_WINDOW)
+        i = 0
+        try:
+            while i < len(pairs):
+                window = []
+                # Pairs the aggressive prefilter skips take no oracle check, so no room in the window
+                while i < len(pairs) and len([entry for entry in window if entry[5]]) < PARALLEL_COALESCE_WINDOW:
+                    pair = current_pair(pairs[i])
+                    i += 1
+                    if pair is None or pair in [(first, second) for _, first, second, *_ in window]:
+                        continue
+                    first, second = pair
+                    unlikely = pruned(first, second)
+                    if unlikely and PAIR_PREFILTER == 'aggressive':
+                        state = random.getstate()
+                        window.append((i, first, second, None, None, None, state, state, unlikely, None, False))
+                        continue
+                    s = time.time()
+                    first_strings = list(dict.fromkeys(lvl_n_derivable(tree_list, first, 0)))
+                    second_strings = list(dict.fromkeys(lvl_n_derivable(tree_list, second, 0)))
+                    TIME_GENERATING_EXAMPLES += time.time() - s
+                    key = rejection_key(first_strings, second, tree_list)
+                    future = None
+                    replaced_strings = None
+                    unsampled = random.getstate()
+                    rejected = known_rejection(key)
+                    if not rejected:
+                        replaced_strings = sampled_replacements(first_strings, second, tree_list)
+                        pending = [entry[9] for entry in window if entry[5]]
+                        if replaced_strings and (key is None or key not in pending):
+                            future = executor.submit(oracle.parse_many, replaced_strings,
+                                                     speculative=SPECULATIVE_VALIDATION)
+                    window.append((i, first, second, second_strings, future, replaced_strings, unsampled,
+                                   random.getstate(), unlikely, key, rejected))
+
+                for pos, (next_idx, first, second, second_strings, future, replaced_strings, unsampled, state,
+                          unlikely, key, rejected) in enumerate(window):
+                    checked.add((first, second))
+                    # Counted here, as a pair in a stale part of the window is prepared again
+                    PREFILTER_PAIRS_PRUNED += unlikely
+                    if replaced_strings and known_rejection(key):
+                        # Rejected by a pair before it in the window since it was prepared
+                        random.setstate(unsampled)
+                        REJECTED_MERGES_SKIPPED += 1
+                        second_valid = False
+                    else:
+                        random.setstate(state)
+                        REJECTED_MERGES_SKIPPED += rejected
+                        if not replaced_strings:
+                            continue
+                        if future is None:
+                            # Held back for the pair before it with the same fingerprint
+                            future = executor.submit(oracle.parse_many, replaced_strings,
+                                                     speculative=SPECULATIVE_VALIDATION)
+                        if not all(future.result()):
+                            remember_rejection(key)
+                            continue
+                        second_valid, _ = replacement_valid(second_strings, first, tree_list)
+                        if second_valid:
+                            merge(first, second)
+                            PREFILTER_MERGES_CHANGED += unlikely
+                    if second_valid or random.getstate() != state:
+                        stale = window[pos + 1:]
+                        for _, _, _, _, stale_future, *_ in stale:
+                            if stale_future is not None:
+                                stale_future.cancel()
+                        COALESCE_PAIRS_REDONE += len(stale)
+                        i = next_idx
+                        break
+        finally:
+            executor.shutdown()
+
+    if coalesce_target is None and PARALLEL_COALESCE_WINDOW > 1:
+        check_pairs_in_parallel(pairs)
+    else:
+        for pair in pairs:
+            pair = current_pair(pair)
+            if pair is None:
+                continue
+            first, second = pair
             checked.add((first, second))
-
-        # If the nonterminals can replace each other in every context, they are replaceable
-        if replacement_valid_and_expanding(first, second, tree_list):
-            if first == START or second == START:
-                class_nt = START
-            else:
-                class_nt = allocate_tid()
-            classes = {class_nt: [first, second]}
-            get_class = {first: class_nt, second: class_nt}
-            coalesced_into[first] = class_nt
-            coalesced_into[second] = class_nt
-            grammar = get_updated_grammar(classes, get_class, grammar)
-            new_inner_trees = get_updated_trees(get_class, tree_list.inner_list)
-            tree_list = ParseTreeList(new_inner_trees, grammar)
-            coalesce_caused = True
-            merges += 1
+            unlikely = pruned(first, second)
+            PREFILTER_PAIRS_PRUNED += unlikely
+            if unlikely and PAIR_PREFILTER == 'aggressive':
+                continue
+            real_calls = oracle.real_calls
+
+            # If the nonterminals can replace each other in every context, they are replaceable
+            if replacement_valid_and_expanding(first, second, tree_list):
+                merge(first, second)
+                PREFILTER_MERGES_CHANGED += unlikely
+            if unlikely:
+                PREFILTER_CALLS_SAVED += oracle.real_calls - real_calls
     trees = tree_list.inner_list
 
     return grammar, trees, coalesce_caused, coalesced_into
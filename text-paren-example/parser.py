@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 from lark import Lark
+import os
 import sys
 
 grammar = """
@@ -9,10 +10,36 @@ expr: "p" expr "p"
     | "n"
 """
 
-if len(sys.argv) != 2:
-    print("ERROR: requires a single filename as argument", file=sys.stderr)
-    exit(1)
-else:
-    input_contents = open(sys.argv[1]).read().rstrip()
-    parser = Lark(grammar)
-    parser.parse(input_contents)
+_parser = None
+
+def accepts(input_contents):
+    """
+    In-process oracle entry point, for `parser.py:accepts` specs (see oracle.py).
+    """
+    global _parser
+    if _parser is None:
+        _parser = Lark(grammar)
+    _parser.parse(input_contents.rstrip())
+    return True
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("ERROR: requires a filename as argument", file=sys.stderr)
+        exit(1)
+    elif sys.argv[1] == "--worker":
+        # Long-lived worker mode, served by oracle.run_worker (oracle.py is in the folder above)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from oracle import run_worker
+        run_worker(accepts)
+    elif len(sys.argv) == 2:
+        input_contents = open(sys.argv[1]).read().rstrip()
+        parser = Lark(grammar)
+        parser.parse(input_contents)
+    else:
+        # Batch mode (see oracle.py): one exit status per file on stdout
+        for filename in sys.argv[1:]:
+            try:
+                accepts(open(filename).read())
+                print(0)
+            except Exception:
+                print(1)
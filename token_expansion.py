@@ -3,12 +3,12 @@ import sys
 from typing import List
 
 from grammar import Grammar, Rule
-from oracle import ExternalOracle, ParseException
+from oracle import ExternalOracle
 from parse_tree import ParseNode, fixup_terminal
 
 import string
 
-from replacement_utils import get_strings_with_replacement, nt_in_tree
+from replacement_utils import get_strings_with_replacement, trees_containing
 
 """
 I'm sorry this code is so so so ugly. 
@@ -119,12 +119,7 @@ def rules_to_add(rule_start):
 
 def try_strings(oracle: ExternalOracle, candidates: List[str]):
 
-    for candidate in candidates:
-        try:
-            oracle.parse(candidate)
-        except ParseException:
-            return False
-    return True
+    return all(oracle.parse_many(candidates))
 
 
 def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: List[ParseNode], rule_start: str, body_idxs: List[int]):
@@ -136,7 +131,7 @@ def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, tree
 
     for c in other_chars:
         c_ok = True
-        for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+        for tree in trees_containing(trees, rule_start):
             candidates = get_strings_with_replacement(tree, rule_start, c)
             if not try_strings(oracle, candidates):
                 c_ok = False
@@ -152,7 +147,7 @@ def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, tree
         longer_whitespaces.append(ws_str)
 
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree in trees_containing(trees, rule_start):
         candidates = get_strings_with_replacement(tree, rule_start, longer_whitespaces)
         if not try_strings(oracle, candidates):
             expand_ok = False
@@ -197,7 +192,7 @@ def generalize_digits_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: L
     ints_ok = True
     digits_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree in trees_containing(trees, rule_start):
         if digit_ok:
             candidates = get_strings_with_replacement(tree, rule_start, single_digit_candidates)
             if not try_strings(oracle, candidates):
@@ -252,7 +247,7 @@ def generalize_letters_in_rule(oracle: ExternalOracle, grammar: Grammar, trees:
     expand_1_ok = True if single_candidates else False
     expand_multi_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree in trees_containing(trees, rule_start):
         if expand_1_ok:
             # we only get in here if we have
             candidates = get_strings_with_replacement(tree, rule_start, single_candidates)
@@ -307,7 +302,7 @@ def generalize_to_alphanum(oracle: ExternalOracle, grammar: Grammar, trees: List
     expand_1_ok = True if single_candidates else False
     expand_multi_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree in trees_containing(trees, rule_start):
         if expand_1_ok:
             # we only get in here if we have
             candidates = get_strings_with_replacement(tree, rule_start, single_candidates)
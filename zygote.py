@@ -0,0 +1,179 @@
+import ast
+import contextlib
+import importlib
+import os
+import sys
+import tempfile
+
+"""
+Zygote server for Python oracle scripts: speaks the worker protocol described
+in oracle.py for any script that can be run as `python SCRIPT filename`.
+
+    $ python zygote.py SCRIPT
+
+runs the body of SCRIPT once, as a module rather than as __main__, and then
+answers each query in a forked child. If SCRIPT defines an `accepts` function
+(the entry point of a `SCRIPT:accepts` oracle spec, see oracle.py), the zygote
+calls it once on an empty input, so that whatever it sets up on first use (such
+as a parser) is built before any fork, and each child only calls it on the
+query's input: returning a true value means valid, a false one or an exception
+means invalid. Otherwise the child runs SCRIPT as __main__ on a file holding the
+input, and its exit status is the verdict, exactly as if SCRIPT had been run on
+its own: exiting with 0 or falling off the end means valid, a non-zero exit or
+an uncaught exception means invalid. Either way, the modules SCRIPT imports are
+loaded once. A child is always forked ahead of the next query, so queries don't
+wait for the fork either.
+
+`make_oracle(..., zygote=True)` in oracle.py, or `--zygote` on the command line,
+sets this up as the worker of an ExternalOracle.
+"""
+
+
+def preload_imports(source: str):
+    """
+    Imports the modules imported at the top level of the script `source`, so
+    forked children start with them loaded. Modules that fail to import are
+    left for the script itself to deal with.
+    """
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass
+
+
+def load_entry_point(code, script_path: str):
+    """
+    Runs the body of the compiled script `code` as a module, and returns its
+    `accepts` function, warmed up on an empty input, or None if it has none or
+    its body fails.
+    """
+    namespace = {'__name__': '__zygote__', '__file__': script_path, '__builtins__': __builtins__}
+    try:
+        exec(code, namespace)
+    except BaseException:
+        return None
+    accepts = namespace.get('accepts')
+    if not callable(accepts):
+        return None
+    try:
+        accepts('')
+    except Exception:
+        pass
+    return accepts
+
+
+def run_script(code, script_path: str, input_path: str, accepts=None):
+    """
+    Runs `accepts` on the contents of `input_path` if given, or else the compiled
+    script `code` as __main__ on it, in a forked child, and exits with the
+    resulting status. Never returns.
+    """
+    status = 0
+    try:
+        if accepts is not None:
+            status = 0 if accepts(open(input_path).read()) else 1
+        else:
+            sys.argv = [script_path, input_path]
+            exec(code, {'__name__': '__main__', '__file__': script_path, '__builtins__': __builtins__})
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code & 0xff
+        else:
+            status = 1
+    except BaseException:
+        status = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    os._exit(status)
+
+
+def fork_spare(code, script_path: str, accepts=None):
+    """
+    Forks a child that waits for an input file name on a pipe and then runs the
+    script (or `accepts`) on it. Returns the child's pid and the write end of the pipe.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(write_end)
+        # The protocol streams belong to the zygote: the script gets /dev/null
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        chunks = []
+        while True:
+            chunk = os.read(read_end, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            # The zygote exited without handing us a query
+            os._exit(0)
+        run_script(code, script_path, b''.join(chunks).decode('utf-8'), accepts)
+    os.close(read_end)
+    return pid, write_end
+
+
+def serve(script_path: str):
+    """
+    Serves the worker protocol on stdin/stdout for the oracle script `script_path`.
+    """
+    source = open(script_path).read()
+    code = compile(source, script_path, 'exec')
+    # stdout carries the protocol, so whatever the script prints while loading goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        preload_imports(source)
+        accepts = load_entry_point(code, script_path)
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    input_file = tempfile.NamedTemporaryFile(prefix='treevada-zygote-')
+    spare = fork_spare(code, script_path, accepts)
+    try:
+        while True:
+            header = stdin.readline()
+            if not header:
+                return
+            data = stdin.read(int(header))
+            input_file.seek(0)
+            input_file.truncate()
+            input_file.write(data)
+            input_file.flush()
+            pid, write_end = spare
+            os.write(write_end, bytes(input_file.name, 'utf-8'))
+            os.close(write_end)
+            _, wait_status = os.waitpid(pid, 0)
+            spare = fork_spare(code, script_path, accepts)
+            if os.WIFEXITED(wait_status):
+                status = os.WEXITSTATUS(wait_status)
+            else:
+                # Killed by a signal, like a crashed oracle process
+                status = 128 + os.WTERMSIG(wait_status)
+            stdout.write(b'%d\n' % status)
+            stdout.flush()
+    finally:
+        pid, write_end = spare
+        os.close(write_end)
+        os.waitpid(pid, 0)
+        input_file.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python zygote.py SCRIPT", file=sys.stderr)
+        exit(1)
+    # Let the script import modules from its own folder, as when run directly
+    sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[1])))
+    serve(sys.argv[1])